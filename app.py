@@ -1,107 +1,156 @@
 from fastapi import FastAPI, UploadFile, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.concurrency import run_in_threadpool
+from concurrent import futures
+import asyncio
+import aiofiles
 import tempfile
 import os
-import subprocess
+import shutil
+import threading
+import uuid
 from doservices import DigitalOceanService
-from moviepy.editor import VideoFileClip
-import aiofiles
-import aiohttp
+from inference import Pipeline, load_lnet_server
+from jobs import JobQueue, max_workers
 
 app = FastAPI()
 do_service = DigitalOceanService()
 
-# Function to execute a CLI command
-def execute_command(command: list) -> None:
-    subprocess.run(command, check=True)
+# Jobs run on warm inference pipelines, one per worker, every one holds its own copy of all the models.
+# The number of workers is bounded by the cores and the available memory (JOB_MEMORY_GB per job).
+PIPELINE_WORKERS = int(os.getenv("PIPELINE_WORKERS", "1"))
+JOB_MEMORY_GB = float(os.getenv("JOB_MEMORY_GB", "6"))
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Archival uploads to object storage run in the background
+archive_pool = futures.ThreadPoolExecutor(max_workers=int(os.getenv("ARCHIVE_WORKERS", "4")))
 
 # Function to handle video processing
-def infer(video_source, audio_target):
+def infer(pipeline, video_source, audio_target, progress=None):
     temp_output_path = tempfile.mktemp(suffix='.mp4')
-    command = [
-        "python", 
-        "inference.py",
-        f"--face={video_source}",
-        f"--audio={audio_target}",
-        f"--outfile={temp_output_path}"
-    ]
-
-    execute_command(command)
-
-    # Load the processed video
-    video = VideoFileClip(temp_output_path)
-    output_file = tempfile.mktemp(suffix='.mp4')
-
-    # Save the processed video with desired codec and settings
-    video.write_videofile(output_file, codec="libx264", audio_codec="aac")
-
-    # Clean up the temporary file created by inference
-    os.remove(temp_output_path)
-
-    return output_file
+    tmp_dir = uuid.uuid4().hex
+    try:
+        pipeline.run(video_source, audio_target, progress=progress, outfile=temp_output_path, tmp_dir=tmp_dir)
+    finally:
+        shutil.rmtree(os.path.join('temp', tmp_dir), ignore_errors=True)
+
+    return temp_output_path
+
+# Stream the multipart body to a local temp file in chunks
+async def save_upload(upload, suffix):
+    async with aiofiles.tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as f:
+        while True:
+            chunk = await upload.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            await f.write(chunk)
+        return f.name
+
+def remove_files(*paths):
+    for path in paths:
+        if path is not None and os.path.exists(path):
+            os.remove(path)
+
+# Runs in a job worker: lip-sync the local files while they are archived to object storage
+def process(pipeline, job):
+    params = job.params
+    video_path, audio_path = params['video_path'], params['audio_path']
+    uploads = [archive_pool.submit(do_service.upload_path, video_path, 'video', params['video_filename']),
+               archive_pool.submit(do_service.upload_path, audio_path, 'audio', params['audio_filename'])]
+    output_file, thumbnail_dir = None, tempfile.mkdtemp()
+    try:
+        # Process video and generate output
+        output_file = infer(pipeline, video_path, audio_path, progress=job.update)
+        uploads.append(archive_pool.submit(do_service.upload_path, output_file, 'result', params['video_filename']))
+        thumbnail_url = do_service.generate_thumbnail(video_path, thumbnail_dir, 'user-thumbnail')
+        video_url, audio_url, result_url = [upload.result() for upload in uploads]
+    finally:
+        # Clean up temporary files once they are uploaded
+        futures.wait(uploads)
+        remove_files(video_path, audio_path, output_file)
+        shutil.rmtree(thumbnail_dir, ignore_errors=True)
+
+    return {
+        "video_url": video_url,
+        "audio_url": audio_url,
+        "result_url": result_url,
+        "thumbnail_url": thumbnail_url
+    }
+
+jobs = JobQueue(process, workers=max_workers(JOB_MEMORY_GB * 1024 ** 3, PIPELINE_WORKERS))
+
+# With several workers the pipelines share one LNet/ENet, the partial batches of concurrent jobs are fused
+SHARED_LNET = os.getenv("SHARED_LNET", "1") == "1"
+lnet_lock = threading.Lock()
+lnet_server = None
+
+def make_pipeline():
+    global lnet_server
+    if not SHARED_LNET or jobs.workers == 1:
+        return Pipeline()
+    with lnet_lock:
+        if lnet_server is None:
+            lnet_server = load_lnet_server()
+    return Pipeline(lnet=lnet_server)
+
+@app.on_event("startup")
+def start_workers():
+    # the pipelines are built in the worker threads, the server answers while the models load
+    jobs.start(make_pipeline)
+
+def validate_durations(*paths):
+    for path in paths:
+        do_service.validate_file_duration(path)
+
+async def submit(video, audio):
+    if not video or not audio:
+        raise HTTPException(status_code=400, detail="Both video and audio files are required")
+    video_path = await save_upload(video, '.mp4')
+    audio_path = await save_upload(audio, '.wav')
+    # Validate file durations on the local files
+    try:
+        await run_in_threadpool(validate_durations, video_path, audio_path)
+    except ValueError as e:
+        remove_files(video_path, audio_path)
+        raise HTTPException(status_code=400, detail=str(e))
+    return jobs.submit(video_path=video_path, video_filename=video.filename,
+                       audio_path=audio_path, audio_filename=audio.filename)
 
 @app.get("/")
 async def server_active():
     return {"status": "active", "message": "Server is running"}
 
+@app.post("/jobs")
+async def create_job(video: UploadFile, audio: UploadFile):
+    job = await submit(video, audio)
+    return {"job_id": job.id, "status": job.status}
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    status = job.to_dict()
+    if job.status == 'queued':
+        status['queue_position'] = jobs.position(job)
+    return status
+
 @app.post("/upload")
 async def upload(video: UploadFile, audio: UploadFile):
+    # same as POST /jobs but waits for the result, without blocking the event loop
     try:
-        if not video or not audio:
-            raise HTTPException(status_code=400, detail="Both video and audio files are required")
-
-        video_slug = 'video'
-        audio_slug = 'audio'
-
-        # Upload files to DigitalOcean Spaces
-        video_content = await video.read()
-        audio_content = await audio.read()
-        video_url = do_service.upload_file(video_content, video_slug, video.filename)
-        audio_url = do_service.upload_file(audio_content, audio_slug, audio.filename)
-
-        # Validate file durations
-        try:
-            do_service.validate_file_duration(video_url)
-            do_service.validate_file_duration(audio_url)
-        except ValueError as e:
-            raise HTTPException(status_code=400, detail=str(e))
-
-        # Download files from URLs to temporary files
-        async with aiohttp.ClientSession() as session:
-            async with session.get(video_url) as video_response:
-                video_temp_file = await aiofiles.tempfile.NamedTemporaryFile(delete=False, suffix='.mp4')
-                await video_temp_file.write(await video_response.read())
-                video_temp_path = video_temp_file.name
-
-            async with session.get(audio_url) as audio_response:
-                audio_temp_file = await aiofiles.tempfile.NamedTemporaryFile(delete=False, suffix='.wav')
-                await audio_temp_file.write(await audio_response.read())
-                audio_temp_path = audio_temp_file.name
-
-        # Process video and generate output
-        output_file = infer(video_temp_path, audio_temp_path)
-        file_content = do_service.read_file_content(output_file)
-        result_url = do_service.upload_file(file_content, "result", video.filename)
-        thumbnail_url = do_service.generate_thumbnail(video_url, '/tmp', 'user-thumbnail')
-
-        # Clean up temporary files
-        os.remove(video_temp_path)
-        os.remove(audio_temp_path)
-
-        return {
-            "video_url": video_url,
-            "audio_url": audio_url,
-            "result_url": result_url,
-            "thumbnail_url": thumbnail_url
-        }
-
+        job = await submit(video, audio)
+        return await asyncio.wrap_future(job.future)
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.delete("/delete/{key}")
 async def delete_file(key: str):
     try:
-        do_service.delete_file(key)
+        await do_service.delete_file_async(key)
         return {"message": "File deleted successfully"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -1,27 +1,51 @@
 import boto3
+import asyncio
+import functools
 import ffmpeg
 import uuid
 import os
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from botocore.exceptions import NoCredentialsError, PartialCredentialsError
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from io import BytesIO
-from typing import Optional
+from typing import BinaryIO, Optional, Union
 from dotenv import load_dotenv
+from utils import media_info
 import json
-import subprocess
 
 load_dotenv()
 
+MAX_DURATION = 30
+
 class DigitalOceanService:
     def __init__(self):
+        # one client shared by all the threads, with a connection pool sized for concurrent multipart uploads
+        max_concurrency = int(os.getenv('DO_S3_MAX_CONCURRENCY', '8'))
         self.s3_client = boto3.client(
             's3',
             endpoint_url=os.environ['DO_S3_ENDPOINT'],  # Replace with your endpoint
             region_name=os.environ['DO_S3_REGION'],           # Replace with your region
             aws_access_key_id=os.environ['DO_S3_ACCESS_KEY'],  # Replace with your access key
-            aws_secret_access_key=os.environ['DO_S3_SECRET_ACCESS_KEY']  # Replace with your secret key
+            aws_secret_access_key=os.environ['DO_S3_SECRET_ACCESS_KEY'],  # Replace with your secret key
+            config=Config(
+                max_pool_connections=int(os.getenv('DO_S3_MAX_POOL_CONNECTIONS', '32')),
+                retries={'max_attempts': 5, 'mode': 'adaptive'},
+                tcp_keepalive=True
+            )
         )
         self.bucket_name = os.environ['DO_S3_SPACENAME']  # Replace with your bucket name
+        # files larger than the part size are uploaded in parts, max_concurrency parts at a time
+        part_size = int(float(os.getenv('DO_S3_PART_SIZE_MB', '8')) * 1024 * 1024)
+        self.transfer_config = TransferConfig(
+            multipart_threshold=part_size,
+            multipart_chunksize=part_size,
+            max_concurrency=max_concurrency,
+            use_threads=True
+        )
+        # runs the blocking calls for the async wrappers
+        self.executor = ThreadPoolExecutor(max_workers=int(os.getenv('DO_S3_ASYNC_WORKERS', '4')))
 
     def delete_file(self, key: str) -> None:
         try:
@@ -29,27 +53,47 @@ class DigitalOceanService:
         except (NoCredentialsError, PartialCredentialsError) as e:
             raise Exception(f"Failed to delete file from DigitalOcean: {str(e)}")
 
-    def upload_file(self, file_content: bytes, slug: str, filename: str) -> str:
+    def upload_file(self, file_content: Union[bytes, BinaryIO], slug: str, filename: str) -> str:
+        if isinstance(file_content, bytes):
+            file_content = BytesIO(file_content)
+        return self.upload_fileobj(file_content, slug, filename)
+
+    def upload_fileobj(self, fileobj: BinaryIO, slug: str, filename: str) -> str:
+        # streamed, multipart above the part size
         timestamp = uuid.uuid4().hex
         key = f"{slug}/{timestamp}-{filename}"
         try:
-            self.s3_client.put_object(
-                Bucket=self.bucket_name,
-                Key=key,
-                Body=file_content,
-                ACL='public-read'
+            self.s3_client.upload_fileobj(
+                fileobj,
+                self.bucket_name,
+                key,
+                ExtraArgs={'ACL': 'public-read'},
+                Config=self.transfer_config
             )
             return f"https://cdn.allwebtool.com/{key}"
         except (NoCredentialsError, PartialCredentialsError) as e:
             raise Exception(f"Failed to upload file to DigitalOcean: {str(e)}")
 
+    def upload_path(self, path: str, slug: str, filename: str) -> str:
+        with open(path, 'rb') as f:
+            return self.upload_fileobj(f, slug, filename)
+
+    async def run_async(self, fn, *args):
+        # run a blocking method in the thread pool, e.g. await do_service.run_async(do_service.upload_path, path, slug, name)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(fn, *args))
+
+    async def upload_path_async(self, path: str, slug: str, filename: str) -> str:
+        return await self.run_async(self.upload_path, path, slug, filename)
+
+    async def delete_file_async(self, key: str) -> None:
+        return await self.run_async(self.delete_file, key)
+
     def get_file_duration(self, url):
         try:
-            ffprobe_cmd = f"ffprobe -v error -show_entries format=duration -of default=noprint_wrappers=1:nokey=1 {url}"
-            output = subprocess.check_output(ffprobe_cmd, shell=True)
-            duration = float(output.decode('utf-8').strip())
-            return duration
-        except subprocess.CalledProcessError as e:
+            # cached per file, the pipeline reuses the probe
+            return media_info.probe(url).duration
+        except (ffmpeg.Error, OSError) as e:
             print(f"Error: {e}")
             return None
 
@@ -59,9 +103,8 @@ class DigitalOceanService:
         if not duration:
             raise ValueError(f"Could not determine duration for file: {url}")
 
-        duration = float(duration)
-        if duration > 30:
-            raise ValueError('File exceeds 30 seconds')
+        if duration > MAX_DURATION:
+            raise ValueError(f'File exceeds {MAX_DURATION} seconds')
 
     def generate_thumbnail(self, video_url: str, folder: str, slug: str) -> str:
         thumbnail_filename = f"{slug}-thumbnail.png"
@@ -70,10 +113,7 @@ class DigitalOceanService:
         try:
             ffmpeg.input(video_url).output(str(thumbnail_path), vframes=1, s='320x240').run()
             
-            with open(thumbnail_path, 'rb') as f:
-                thumbnail_buffer = f.read()
-                
-            thumbnail_url = self.upload_file(thumbnail_buffer, "thumbnails", thumbnail_filename)
+            thumbnail_url = self.upload_path(str(thumbnail_path), "thumbnails", thumbnail_filename)
             
             thumbnail_path.unlink()  # Clean up the temporary thumbnail file
             
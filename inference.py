@@ -1,6 +1,7 @@
 import numpy as np
-import cv2, os, sys, subprocess, platform, torch
+import cv2, os, sys, copy, torch
 from tqdm import tqdm
+from concurrent import futures
 from PIL import Image
 from scipy.io import loadmat
 
@@ -11,334 +12,548 @@ sys.path.insert(0, 'third_part/GFPGAN')
 # 3dmm extraction
 from third_part.face3d.util.preprocess import align_img
 from third_part.face3d.util.load_mats import load_lm3d
-from third_part.face3d.extract_kp_videos import KeypointExtractor
 # face enhancement
 from third_part.GPEN.gpen_face_enhancer import FaceEnhancement
 from third_part.GFPGAN.gfpgan import GFPGANer
 # expression control
 from third_part.ganimation_replicate.model.ganimation import GANimationModel
 
-from utils import audio
-from utils.ffhq_preprocess import Croper
+from utils import audio, media_info, model_registry
+from utils.frame_stream import FrameStream, fill_missing_landmarks
+from utils.preprocess_cache import PreprocessCache
+from utils.ffmpeg_writer import FFmpegWriter
+from utils.precision import set_precision
+from utils.micro_batcher import MicroBatcher
+from models import load_exported, load_network, load_DNet
 from utils.alignment_stit import crop_faces, calc_alignment_coefficients, paste_image
-from utils.inference_utils import Laplacian_Pyramid_Blending_with_mask, face_detect, load_model, options, split_coeff, \
-                                  trans_image, transform_semantic, find_crop_norm_ratio, load_face3d_net, exp_aus_dict
+from utils.inference_utils import blend_frames, face_detect, face_detect_rects, face_boxes, \
+                                  load_model, options, split_coeff, trans_image, transform_semantic_batch, find_crop_norm_ratios, \
+                                  load_face3d_net, exp_aus_dict, AlignedFramesDataset, landmarks_to_5points
 import warnings
 warnings.filterwarnings("ignore")
 
-args = options()
-
-def main():    
-    device = 'cuda' if torch.cuda.is_available() else 'cpu'
-    print('[Info] Using {} for inference.'.format(device))
-    os.makedirs(os.path.join('temp', args.tmp_dir), exist_ok=True)
-
-    enhancer = FaceEnhancement(base_dir='checkpoints', size=512, model='GPEN-BFR-512', use_sr=False, \
-                               sr_model='rrdb_realesrnet_psnr', channel_multiplier=2, narrow=1, device=device)
-    restorer = GFPGANer(model_path='checkpoints/GFPGANv1.3.pth', upscale=1, arch='clean', \
-                        channel_multiplier=2, bg_upsampler=None)
-
-    base_name = args.face.split('/')[-1]
-    if os.path.isfile(args.face) and args.face.split('.')[1] in ['jpg', 'png', 'jpeg']:
-        args.static = True
-    if not os.path.isfile(args.face):
-        raise ValueError('--face argument must be a valid path to video/image file')
-    elif args.face.split('.')[1] in ['jpg', 'png', 'jpeg']:
-        full_frames = [cv2.imread(args.face)]
-        fps = args.fps
-    else:
-        video_stream = cv2.VideoCapture(args.face)
-        fps = video_stream.get(cv2.CAP_PROP_FPS)
-
-        full_frames = []
-        while True:
-            still_reading, frame = video_stream.read()
-            if not still_reading:
-                video_stream.release()
-                break
-            y1, y2, x1, x2 = args.crop
-            if x2 == -1: x2 = frame.shape[1]
-            if y2 == -1: y2 = frame.shape[0]
-            frame = frame[y1:y2, x1:x2]
-            full_frames.append(frame)
-
-    print ("[Step 0] Number of frames available for inference: "+str(len(full_frames)))
-    # face detection & cropping, cropping the first frame as the style of FFHQ
-    croper = Croper('checkpoints/shape_predictor_68_face_landmarks.dat')
-    full_frames_RGB = [cv2.cvtColor(frame, cv2.COLOR_BGR2RGB) for frame in full_frames]
-    full_frames_RGB, crop, quad = croper.crop(full_frames_RGB, xsize=512)
 
-    clx, cly, crx, cry = crop
-    lx, ly, rx, ry = quad
-    lx, ly, rx, ry = int(lx), int(ly), int(rx), int(ry)
-    oy1, oy2, ox1, ox2 = cly+ly, min(cly+ry, full_frames[0].shape[0]), clx+lx, min(clx+rx, full_frames[0].shape[1])
-    # original_size = (ox2 - ox1, oy2 - oy1)
-    frames_pil = [Image.fromarray(cv2.resize(frame,(256,256))) for frame in full_frames_RGB]
-
-    # get the landmark according to the detected face.
-    if not os.path.isfile('temp/'+base_name+'_landmarks.txt') or args.re_preprocess:
-        print('[Step 1] Landmarks Extraction in Video.')
-        kp_extractor = KeypointExtractor()
-        lm = kp_extractor.extract_keypoint(frames_pil, './temp/'+base_name+'_landmarks.txt')
-    else:
-        print('[Step 1] Using saved landmarks.')
-        lm = np.loadtxt('temp/'+base_name+'_landmarks.txt').astype(np.float32)
-        lm = lm.reshape([len(full_frames), -1, 2])
-       
-    if not os.path.isfile('temp/'+base_name+'_coeffs.npy') or args.exp_img is not None or args.re_preprocess:
-        net_recon = load_face3d_net(args.face3d_net_path, device)
-        lm3d_std = load_lm3d('checkpoints/BFM')
+class Pipeline:
+    """Lip-sync pipeline with every model loaded once.
+
+    ``opt`` holds the default options (see ``utils.inference_utils.options``). ``run`` can be
+    called any number of times; options passed to it as keyword arguments only apply to that run.
+    ``lnet`` is an LNet/ENet shared by several pipelines (see ``load_lnet_server``), by default the
+    pipeline loads its own.
+    """
+
+    def __init__(self, opt=None, device=None, lnet=None):
+        self.opt = opt if opt is not None else options(['--face', '', '--audio', ''])
+        self.device = device or ('cuda' if torch.cuda.is_available() else 'cpu')
+        print('[Info] Using {} for inference.'.format(self.device))
+
+        # detectors and landmark models are shared process-wide, see utils.model_registry
+        self.croper = model_registry.get('croper')
+        self.kp_extractor = model_registry.get('kp_extractor')
+        self.face_detector = model_registry.get('face_detector')
+        self.enhancer = FaceEnhancement(base_dir='checkpoints', size=512, model='GPEN-BFR-512', use_sr=False, \
+                                        sr_model='rrdb_realesrnet_psnr', channel_multiplier=2, narrow=1, device=self.device,
+                                        facedetector=model_registry.get('retinaface'))
+        # FaceRestoreHelper keeps per-image state, every pipeline has its own GFPGANer around the shared retinaface
+        self.restorer = GFPGANer(model_path='checkpoints/GFPGANv1.3.pth', upscale=1, arch='clean', \
+                                 channel_multiplier=2, bg_upsampler=None, face_det=model_registry.get('gfpgan_face_det'))
+        self.net_recon = load_face3d_net(self.opt.face3d_net_path, self.device)
+        self.lm3d_std = load_lm3d('checkpoints/BFM')
+        self.align_pool = futures.ThreadPoolExecutor(max_workers=max(1, self.opt.face3d_workers))
+        # load DNet, model(LNet and ENet)
+        if lnet is None:
+            self.D_Net, self.model = load_model(self.opt, self.device)
+        else:
+            self.D_Net, self.model = load_DNet(self.opt, self.device).to(self.device), lnet
+        if self.opt.backend != 'torch':
+            self.enhancer.facegan.model = load_exported(self.opt, 'GPEN-BFR-512', self.device)
+            self.enhancer.faceparser.faceparse = load_exported(self.opt, 'ParseNet', self.device)
+        self.ganimation = None
+
+        # fp16/bf16 autocast and channels_last for the generators and the face parser, see utils.precision
+        nets = [self.D_Net, self.enhancer.facegan.model, self.enhancer.faceparser.faceparse, self.restorer.gfpgan]
+        for net in nets + ([self.model] if lnet is None else []):
+            set_precision(net, self.device, self.opt.precision, self.opt.channels_last)
+
+    def run(self, face, audio, progress=None, **opts):
+        # progress(step, fraction of the step done) is called as the steps complete, see report
+        args = copy.copy(self.opt)
+        args.face, args.audio, args.progress = face, audio, progress
+        for key, value in opts.items():
+            setattr(args, key, value)
+
+        os.makedirs(os.path.join('temp', args.tmp_dir), exist_ok=True)
+        if os.path.isfile(args.face) and args.face.split('.')[1] in ['jpg', 'png', 'jpeg']:
+            args.static = True
+        if not os.path.isfile(args.face):
+            raise ValueError('--face argument must be a valid path to video/image file')
+
+        # probe both inputs before decoding anything, to reject long ones and to pick the processing path
+        face_info, audio_info = media_info.probe(args.face), media_info.probe(args.audio)
+        media_info.check_duration(face_info, args.max_duration)
+        media_info.check_duration(audio_info, args.max_duration)
+        if not args.stream and not args.static and args.stream_above > 0 and face_info.decoded_bytes > args.stream_above * 1024 ** 3:
+            print('[Info] The decoded video would take {:.1f} GB, processing it with --stream.'.format(face_info.decoded_bytes / 1024 ** 3))
+            args.stream = True
+
+        cache = PreprocessCache(args.cache_dir, int(args.cache_size * 1024 ** 3))
+        stream = FrameStream(args.face, crop=args.crop, chunk_size=args.chunk_size, fps=args.fps, info=face_info)
+        if args.stream and not args.static:
+            self.run_stream(args, stream, cache)
+        else:
+            self.run_in_memory(args, stream, cache)
+        torch.cuda.empty_cache()
+        print('outfile:', args.outfile)
+        return args.outfile
+
+    def cache_keys(self, args, cache):
+        # landmarks and coeffs only depend on the cropped frames, the stabilized frames also on the expression
+        # and on how DNet runs (autocast precision, torch or exported backend)
+        coeffs_key = cache.key(args.face, crop=args.crop, face3d_net_path=args.face3d_net_path, track_interval=args.track_interval)
+        if args.exp_img is not None and os.path.isfile(args.exp_img):
+            stablized_key = cache.key(args.face, args.exp_img, crop=args.crop, one_shot=args.one_shot, DNet_path=args.DNet_path,
+                                      face3d_net_path=args.face3d_net_path, track_interval=args.track_interval,
+                                      precision=self.opt.precision, backend=self.opt.backend)
+        else:
+            stablized_key = cache.key(args.face, crop=args.crop, exp_img=args.exp_img, one_shot=args.one_shot, DNet_path=args.DNet_path,
+                                      face3d_net_path=args.face3d_net_path, track_interval=args.track_interval,
+                                      precision=self.opt.precision, backend=self.opt.backend)
+        return coeffs_key, stablized_key
+
+    def run_in_memory(self, args, stream, cache):
+        full_frames = stream.read_all()
+        fps = stream.fps
+
+        print ("[Step 0] Number of frames available for inference: "+str(len(full_frames)))
+        # face detection & cropping, cropping the first frame as the style of FFHQ
+        full_frames_RGB = [cv2.cvtColor(frame, cv2.COLOR_BGR2RGB) for frame in full_frames]
+        full_frames_RGB, crop, quad = self.croper.crop(full_frames_RGB, xsize=512)
+        oy1, oy2, ox1, ox2 = crop_region(crop, quad, full_frames[0].shape)
+        # original_size = (ox2 - ox1, oy2 - oy1)
+        frames_pil = [Image.fromarray(cv2.resize(frame,(256,256))) for frame in full_frames_RGB]
+        report(args, 0)
+
+        coeffs_key, stablized_key = self.cache_keys(args, cache)
+        # get the landmark according to the detected face.
+        lm = None if args.re_preprocess else cache.load(coeffs_key, 'landmarks')
+        if lm is None:
+            print('[Step 1] Landmarks Extraction in Video.')
+            lm = self.kp_extractor.extract_keypoint_batch(frames_pil, batch_size=args.kp_batch_size, track_interval=args.track_interval)
+            cache.save(coeffs_key, 'landmarks', lm.astype(np.float32))
+        else:
+            print('[Step 1] Using cached landmarks.')
+        # the cache holds the raw landmarks in both modes, frames without a face reuse the previous landmarks
+        lm = fill_missing_landmarks(np.array(lm))
+        report(args, 1)
+
+        semantic_npy = None if args.re_preprocess else cache.load(coeffs_key, 'coeffs')
+        if semantic_npy is None:
+            semantic_npy = self.extract_coeffs(args, frames_pil, lm)
+            cache.save(coeffs_key, 'coeffs', semantic_npy)
+        else:
+            print('[Step 2] Using cached coeffs.')
+        report(args, 2)
+
+        # the stabilized frames are written to and read from a memory-mapped file, frames are paged in on demand
+        imgs = None if args.re_preprocess else cache.load(stablized_key, 'stablized', mmap_mode='r')
+        if imgs is None:
+            expression = self.load_expression(args)
+            imgs = cache.open_memmap(stablized_key, 'stablized', (len(frames_pil), 256, 256, 3))
+            try:
+                self.stabilize(args, frames_pil, range(len(frames_pil)), semantic_npy, expression, frames_pil[0], out=imgs)
+            except BaseException:
+                cache.discard_memmap(imgs)
+                raise
+            cache.save_memmap(stablized_key, 'stablized', imgs)
+            imgs = cache.load(stablized_key, 'stablized', mmap_mode='r')
+        else:
+            print('[Step 3] Using cached stabilized video.')
+        report(args, 3)
+        torch.cuda.empty_cache()
 
-        video_coeffs = []
-        for idx in tqdm(range(len(frames_pil)), desc="[Step 2] 3DMM Extraction In Video:"):
-            frame = frames_pil[idx]
-            W, H = frame.size
-            lm_idx = lm[idx].reshape([-1, 2])
-            if np.mean(lm_idx) == -1:
-                lm_idx = (lm3d_std[:, :2]+1) / 2.
-                lm_idx = np.concatenate([lm_idx[:, :1] * W, lm_idx[:, 1:2] * H], 1)
+        mel_chunks = self.load_mel_chunks(args, fps)
+        report(args, 4)
+        imgs = imgs[:len(mel_chunks)]
+        full_frames = full_frames[:len(mel_chunks)]
+        lm = lm[:len(mel_chunks)]
+
+        imgs_enhanced = self.enhance_references(imgs)
+        report(args, 5)
+        landmarks_5 = landmarks_to_5points(lm, (oy1,oy2,ox1,ox2)) if args.aligned_enhance else None
+        gen = self.datagen(args, imgs_enhanced.copy(), mel_chunks, full_frames, None, (oy1,oy2,ox1,ox2), landmarks_5=landmarks_5)
+
+        frame_h, frame_w = full_frames[0].shape[:-1]
+        pbar = tqdm(desc='[Step 6] Lip Synthesis:', total=len(mel_chunks))
+        with FFmpegWriter(args.outfile, fps, (frame_w, frame_h), args.audio, vcodec=args.vcodec, preset=args.preset, crf=args.crf) as out:
+            self.synthesize(args, gen, out, pbar)
+        pbar.close()
+
+    def run_stream(self, args, stream, cache):
+        # pass 1: decode the clip chunk by chunk and keep only the small per-frame results
+        # (crop geometry, landmarks, 3dmm coeffs and face boxes), the frames themselves are dropped.
+        fps = stream.fps
+        coeffs_key, _ = self.cache_keys(args, cache)
+        lm_saved = None if args.re_preprocess else cache.load(coeffs_key, 'landmarks')
+        semantic_npy = None if args.re_preprocess else cache.load(coeffs_key, 'coeffs')
+        use_saved_lm, use_saved_coeffs = lm_saved is not None, semantic_npy is not None
+
+        if use_saved_lm:
+            print('[Step 1] Using cached landmarks.')
+        if use_saved_coeffs:
+            print('[Step 2] Using cached coeffs.')
+
+        crop, quad, source_pil, frame_shape = None, None, None, None
+        lm_raw, lm, video_coeffs, rects = [], [], [], []
+        print('[Step 0-2] Streaming landmarks and 3DMM extraction, chunk size: {}'.format(stream.chunk_size))
+        for start, full_frames in tqdm(stream.chunks(), desc='Chunks:'):
+            full_frames_RGB = [cv2.cvtColor(frame, cv2.COLOR_BGR2RGB) for frame in full_frames]
+            if crop is None:
+                crop, quad = self.croper.get_crop(full_frames_RGB, xsize=512)
+                frame_shape = full_frames[0].shape
+            full_frames_RGB = self.croper.apply_crop(full_frames_RGB, crop, quad)
+            frames_pil = [Image.fromarray(cv2.resize(frame,(256,256))) for frame in full_frames_RGB]
+            if source_pil is None:
+                source_pil = frames_pil[0]
+
+            if use_saved_lm:
+                raw_chunk = lm_saved[start:start+len(frames_pil)]
             else:
-                lm_idx[:, -1] = H - 1 - lm_idx[:, -1]
-
-            trans_params, im_idx, lm_idx, _ = align_img(frame, lm_idx, lm3d_std)
-            trans_params = np.array([float(item) for item in np.hsplit(trans_params, 5)]).astype(np.float32)
-            im_idx_tensor = torch.tensor(np.array(im_idx)/255., dtype=torch.float32).permute(2, 0, 1).to(device).unsqueeze(0) 
+                raw_chunk = self.kp_extractor.extract_keypoint_batch(frames_pil, info=False, batch_size=args.kp_batch_size,
+                                                                     track_interval=args.track_interval)
+                lm_raw.append(raw_chunk)
+            # raw landmarks are cached like in run_in_memory, the chunk is filled across the chunk boundary
+            if len(lm) > 0:
+                lm_chunk = fill_missing_landmarks(np.concatenate([lm[-1][-1:], raw_chunk], 0))[1:]
+            else:
+                lm_chunk = fill_missing_landmarks(np.array(raw_chunk))
+            lm.append(lm_chunk)
+            if not use_saved_coeffs:
+                video_coeffs.append(self.extract_coeffs(args, frames_pil, lm_chunk, info=False))
+            rects.extend(face_detect_rects(full_frames, args, self.face_detector))
+        num_frames = len(stream)
+        print ("[Step 0] Number of frames available for inference: "+str(num_frames))
+        oy1, oy2, ox1, ox2 = crop_region(crop, quad, frame_shape)
+        report(args, 2)
+
+        if not use_saved_lm:
+            cache.save(coeffs_key, 'landmarks', np.concatenate(lm_raw, 0).astype(np.float32))
+        lm = np.concatenate(lm, 0)
+        landmarks_5 = landmarks_to_5points(lm, (oy1,oy2,ox1,ox2)) if args.aligned_enhance else None
+        if not use_saved_coeffs:
+            semantic_npy = np.concatenate(video_coeffs, 0)
+            cache.save(coeffs_key, 'coeffs', semantic_npy)
+
+        face_coords = [(y1, y2, x1, x2) for (x1, y1, x2, y2) in face_boxes(rects, frame_shape, args, jaw_correction=True)]
+        expression = self.load_expression(args)
+        mel_chunks = self.load_mel_chunks(args, fps)
+        report(args, 4)
+
+        # pass 2: decode again, frames flow through steps 3, 5 and 6 one chunk at a time.
+        frame_h, frame_w = frame_shape[:-1]
+        pbar = tqdm(desc='[Step 6] Lip Synthesis:', total=len(mel_chunks))
+        with FFmpegWriter(args.outfile, fps, (frame_w, frame_h), args.audio, vcodec=args.vcodec, preset=args.preset, crf=args.crf) as out:
+            for start, full_frames in stream.chunks(num_frames=len(mel_chunks), loop=True):
+                indices = [(start + i) % num_frames for i in range(len(full_frames))]
+                frames_pil = to_frames_pil(self.croper, full_frames, crop, quad)
+                imgs = self.stabilize(args, frames_pil, indices, semantic_npy, expression, source_pil, info=False)
+                imgs_enhanced = self.enhance_references(imgs, info=False)
+                gen = self.datagen(args, imgs_enhanced, mel_chunks[start:start+len(full_frames)], full_frames, None, (oy1,oy2,ox1,ox2),
+                                   face_coords=[face_coords[idx] for idx in indices],
+                                   landmarks_5=[landmarks_5[idx] for idx in indices] if landmarks_5 is not None else None)
+                self.synthesize(args, gen, out, pbar)
+        pbar.close()
+
+    def extract_coeffs(self, args, frames_pil, lm, info=True):
+        # align_img runs in the pipeline's align threads (no forked loader workers, the service runs threads)
+        # for the next batch while net_recon runs on the current one
+        dataset = AlignedFramesDataset(frames_pil, lm, self.lm3d_std)
+        batch_size = args.face3d_batch_size
+        align = lambda start: [self.align_pool.submit(dataset.__getitem__, i) for i in range(start, min(start + batch_size, len(dataset)))]
+        batch_starts = range(0, len(dataset), batch_size)
+        pending = align(0)
+        video_coeffs = []
+        batches = tqdm(batch_starts, desc="[Step 2] 3DMM Extraction In Video:") if info else batch_starts
+        for start in batches:
+            items = [item.result() for item in pending]
+            pending = align(start + batch_size)
+            im_tensor = torch.stack([img for img, _ in items])
+            trans_params = torch.stack([params for _, params in items])
             with torch.no_grad():
-                coeffs = split_coeff(net_recon(im_idx_tensor))
+                coeffs = split_coeff(self.net_recon(im_tensor.to(self.device)))
 
             pred_coeff = {key:coeffs[key].cpu().numpy() for key in coeffs}
             pred_coeff = np.concatenate([pred_coeff['id'], pred_coeff['exp'], pred_coeff['tex'], pred_coeff['angle'],\
-                                         pred_coeff['gamma'], pred_coeff['trans'], trans_params[None]], 1)
+                                         pred_coeff['gamma'], pred_coeff['trans'], trans_params.numpy()], 1)
             video_coeffs.append(pred_coeff)
-        semantic_npy = np.array(video_coeffs)[:,0]
-        np.save('temp/'+base_name+'_coeffs.npy', semantic_npy)
-    else:
-        print('[Step 2] Using saved coeffs.')
-        semantic_npy = np.load('temp/'+base_name+'_coeffs.npy').astype(np.float32)
-
-    # generate the 3dmm coeff from a single image
-    if args.exp_img is not None and ('.png' in args.exp_img or '.jpg' in args.exp_img):
-        print('extract the exp from',args.exp_img)
-        exp_pil = Image.open(args.exp_img).convert('RGB')
-        lm3d_std = load_lm3d('third_part/face3d/BFM')
-        
-        W, H = exp_pil.size
-        kp_extractor = KeypointExtractor()
-        lm_exp = kp_extractor.extract_keypoint([exp_pil], 'temp/'+base_name+'_temp.txt')[0]
-        if np.mean(lm_exp) == -1:
-            lm_exp = (lm3d_std[:, :2] + 1) / 2.
-            lm_exp = np.concatenate(
-                [lm_exp[:, :1] * W, lm_exp[:, 1:2] * H], 1)
+        return np.concatenate(video_coeffs, 0)
+
+    def load_expression(self, args):
+        # generate the 3dmm coeff from a single image
+        if args.exp_img is not None and ('.png' in args.exp_img or '.jpg' in args.exp_img):
+            print('extract the exp from',args.exp_img)
+            exp_pil = Image.open(args.exp_img).convert('RGB')
+            lm3d_std = load_lm3d('third_part/face3d/BFM')
+
+            W, H = exp_pil.size
+            lm_exp = self.kp_extractor.extract_keypoint([exp_pil])[0]
+            if np.mean(lm_exp) == -1:
+                lm_exp = (lm3d_std[:, :2] + 1) / 2.
+                lm_exp = np.concatenate(
+                    [lm_exp[:, :1] * W, lm_exp[:, 1:2] * H], 1)
+            else:
+                lm_exp[:, -1] = H - 1 - lm_exp[:, -1]
+
+            trans_params, im_exp, lm_exp, _ = align_img(exp_pil, lm_exp, lm3d_std)
+            trans_params = np.array([float(item) for item in np.hsplit(trans_params, 5)]).astype(np.float32)
+            im_exp_tensor = torch.tensor(np.array(im_exp)/255., dtype=torch.float32).permute(2, 0, 1).to(self.device).unsqueeze(0)
+            with torch.no_grad():
+                expression = split_coeff(self.net_recon(im_exp_tensor))['exp'][0]
+        elif args.exp_img == 'smile':
+            expression = torch.tensor(loadmat('checkpoints/expression.mat')['expression_mouth'])[0]
         else:
-            lm_exp[:, -1] = H - 1 - lm_exp[:, -1]
-
-        trans_params, im_exp, lm_exp, _ = align_img(exp_pil, lm_exp, lm3d_std)
-        trans_params = np.array([float(item) for item in np.hsplit(trans_params, 5)]).astype(np.float32)
-        im_exp_tensor = torch.tensor(np.array(im_exp)/255., dtype=torch.float32).permute(2, 0, 1).to(device).unsqueeze(0)
-        with torch.no_grad():
-            expression = split_coeff(net_recon(im_exp_tensor))['exp'][0]
-        del net_recon
-    elif args.exp_img == 'smile':
-        expression = torch.tensor(loadmat('checkpoints/expression.mat')['expression_mouth'])[0]
-    else:
-        print('using expression center')
-        expression = torch.tensor(loadmat('checkpoints/expression.mat')['expression_center'])[0]
-
-    # load DNet, model(LNet and ENet)
-    D_Net, model = load_model(args, device)
-
-    if not os.path.isfile('temp/'+base_name+'_stablized.npy') or args.re_preprocess:
+            print('using expression center')
+            expression = torch.tensor(loadmat('checkpoints/expression.mat')['expression_center'])[0]
+        return expression
+
+    # frames_pil[k] is the frame with index indices[k] in the video, semantic_npy covers the whole video
+    def stabilize(self, args, frames_pil, indices, semantic_npy, expression, source_pil, info=True, out=None):
+        indices = np.asarray(indices)
+        if args.one_shot:
+            # source image and crop ratio are the same for every frame
+            source_img = trans_image(source_pil).unsqueeze(0).to(self.device)
+            ratio = find_crop_norm_ratios(semantic_npy[0:1], semantic_npy)
+        expression = expression[None, :64, None].to(self.device)
+
         imgs = []
-        for idx in tqdm(range(len(frames_pil)), desc="[Step 3] Stabilize the expression In Video:"):
+        batch_starts = range(0, len(indices), args.DNet_batch_size)
+        i_range = tqdm(batch_starts, desc="[Step 3] Stabilize the expression In Video:") if info else batch_starts
+        for start in i_range:
+            batch_indices = indices[start:start + args.DNet_batch_size]
             if args.one_shot:
-                source_img = trans_image(frames_pil[0]).unsqueeze(0).to(device)
-                semantic_source_numpy = semantic_npy[0:1]
+                source_imgs = source_img.expand(len(batch_indices), -1, -1, -1)
+                ratios = np.repeat(ratio, len(batch_indices))
             else:
-                source_img = trans_image(frames_pil[idx]).unsqueeze(0).to(device)
-                semantic_source_numpy = semantic_npy[idx:idx+1]
-            ratio = find_crop_norm_ratio(semantic_source_numpy, semantic_npy)
-            coeff = transform_semantic(semantic_npy, idx, ratio).unsqueeze(0).to(device)
-        
+                source_imgs = torch.stack([trans_image(frame) for frame in frames_pil[start:start + len(batch_indices)]]).to(self.device)
+                # (batch, N) distances per batch, the whole video at once would be (N, N)
+                ratios = find_crop_norm_ratios(semantic_npy[batch_indices], semantic_npy)
+            coeff = transform_semantic_batch(semantic_npy, batch_indices, ratios).to(self.device)
+
             # hacking the new expression
-            coeff[:, :64, :] = expression[None, :64, None].to(device) 
+            coeff[:, :64, :] = expression
             with torch.no_grad():
-                output = D_Net(source_img, coeff)
-            img_stablized = np.uint8((output['fake_image'].squeeze(0).permute(1,2,0).cpu().clamp_(-1, 1).numpy() + 1 )/2. * 255)
-            imgs.append(cv2.cvtColor(img_stablized,cv2.COLOR_RGB2BGR)) 
-        np.save('temp/'+base_name+'_stablized.npy',imgs)
-        del D_Net
-    else:
-        print('[Step 3] Using saved stabilized video.')
-        imgs = np.load('temp/'+base_name+'_stablized.npy')
-    torch.cuda.empty_cache()
-
-    if not args.audio.endswith('.wav'):
-        command = 'ffmpeg -loglevel error -y -i {} -strict -2 {}'.format(args.audio, 'temp/{}/temp.wav'.format(args.tmp_dir))
-        subprocess.call(command, shell=True)
-        args.audio = 'temp/{}/temp.wav'.format(args.tmp_dir)
-    wav = audio.load_wav(args.audio, 16000)
-    mel = audio.melspectrogram(wav)
-    if np.isnan(mel.reshape(-1)).sum() > 0:
-        raise ValueError('Mel contains nan! Using a TTS voice? Add a small epsilon noise to the wav file and try again')
-
-    mel_step_size, mel_idx_multiplier, i, mel_chunks = 16, 80./fps, 0, []
-    while True:
-        start_idx = int(i * mel_idx_multiplier)
-        if start_idx + mel_step_size > len(mel[0]):
-            mel_chunks.append(mel[:, len(mel[0]) - mel_step_size:])
-            break
-        mel_chunks.append(mel[:, start_idx : start_idx + mel_step_size])
-        i += 1
-
-    print("[Step 4] Load audio; Length of mel chunks: {}".format(len(mel_chunks)))
-    imgs = imgs[:len(mel_chunks)]
-    full_frames = full_frames[:len(mel_chunks)]  
-    lm = lm[:len(mel_chunks)]
-    
-    imgs_enhanced = []
-    for idx in tqdm(range(len(imgs)), desc='[Step 5] Reference Enhancement'):
-        img = imgs[idx]
-        pred, _, _ = enhancer.process(img, img, face_enhance=True, possion_blending=False)
-        imgs_enhanced.append(pred)
-    gen = datagen(imgs_enhanced.copy(), mel_chunks, full_frames, None, (oy1,oy2,ox1,ox2))
-
-    frame_h, frame_w = full_frames[0].shape[:-1]
-    out = cv2.VideoWriter('temp/{}/result.mp4'.format(args.tmp_dir), cv2.VideoWriter_fourcc(*'mp4v'), fps, (frame_w, frame_h))
-    
-    if args.up_face != 'original':
-        instance = GANimationModel()
-        instance.initialize()
-        instance.setup()
-
-    kp_extractor = KeypointExtractor()
-    for i, (img_batch, mel_batch, frames, coords, img_original, f_frames) in enumerate(tqdm(gen, desc='[Step 6] Lip Synthesis:', total=int(np.ceil(float(len(mel_chunks)) / args.LNet_batch_size)))):
-        img_batch = torch.FloatTensor(np.transpose(img_batch, (0, 3, 1, 2))).to(device)
-        mel_batch = torch.FloatTensor(np.transpose(mel_batch, (0, 3, 1, 2))).to(device)
-        img_original = torch.FloatTensor(np.transpose(img_original, (0, 3, 1, 2))).to(device)/255. # BGR -> RGB
-        
-        with torch.no_grad():
-            incomplete, reference = torch.split(img_batch, 3, dim=1) 
-            pred, low_res = model(mel_batch, img_batch, reference)
-            pred = torch.clamp(pred, 0, 1)
-
-            if args.up_face in ['sad', 'angry', 'surprise']:
-                tar_aus = exp_aus_dict[args.up_face]
-            else:
-                pass
-            
-            if args.up_face == 'original':
-                cur_gen_faces = img_original
+                output = self.D_Net(source_imgs, coeff)
+            imgs_stablized = np.uint8((output['fake_image'].permute(0,2,3,1).cpu().clamp_(-1, 1).numpy() + 1 )/2. * 255)
+            imgs_stablized = [cv2.cvtColor(img_stablized,cv2.COLOR_RGB2BGR) for img_stablized in imgs_stablized]
+            if out is not None:
+                out[start:start + len(batch_indices)] = imgs_stablized
             else:
-                test_batch = {'src_img': torch.nn.functional.interpolate((img_original * 2 - 1), size=(128, 128), mode='bilinear'), 
-                              'tar_aus': tar_aus.repeat(len(incomplete), 1)}
-                instance.feed_batch(test_batch)
-                instance.forward()
-                cur_gen_faces = torch.nn.functional.interpolate(instance.fake_img / 2. + 0.5, size=(384, 384), mode='bilinear')
-                
-            if args.without_rl1 is not False:
-                incomplete, reference = torch.split(img_batch, 3, dim=1)
-                mask = torch.where(incomplete==0, torch.ones_like(incomplete), torch.zeros_like(incomplete)) 
-                pred = pred * mask + cur_gen_faces * (1 - mask) 
-        
-        pred = pred.cpu().numpy().transpose(0, 2, 3, 1) * 255.
+                imgs.extend(imgs_stablized)
+        return imgs if out is None else out
+
+    def load_mel_chunks(self, args, fps):
+        wav = audio.load_wav_ffmpeg(args.audio, 16000)
+        mel = audio.melspectrogram(wav, device=self.device if args.torch_stft else None)
+        if np.isnan(mel.reshape(-1)).sum() > 0:
+            raise ValueError('Mel contains nan! Using a TTS voice? Add a small epsilon noise to the wav file and try again')
+
+        mel_chunks = audio.MelChunks(mel, fps)
+
+        print("[Step 4] Load audio; Length of mel chunks: {}".format(len(mel_chunks)))
+        return mel_chunks
+
+    def enhance_references(self, imgs, info=True):
+        imgs_enhanced = []
+        i_range = tqdm(range(len(imgs)), desc='[Step 5] Reference Enhancement') if info else range(len(imgs))
+        for idx in i_range:
+            img = np.array(imgs[idx]) # imgs can be a read-only memmap
+            pred, _, _ = self.enhancer.process(img, img, face_enhance=True, possion_blending=False)
+            imgs_enhanced.append(pred)
+        return imgs_enhanced
+
+    def load_ganimation(self, args):
+        if args.up_face == 'original':
+            return None
+        if self.ganimation is None:
+            self.ganimation = GANimationModel()
+            self.ganimation.initialize()
+            self.ganimation.setup()
+        return self.ganimation
+
+    def synthesize(self, args, gen, out, pbar):
+        instance = self.load_ganimation(args)
+        for i, (img_batch, mel_batch, frames, coords, img_original, f_frames, lm5s) in enumerate(gen):
+            img_batch = torch.FloatTensor(np.transpose(img_batch, (0, 3, 1, 2))).to(self.device)
+            mel_batch = torch.FloatTensor(np.transpose(mel_batch, (0, 3, 1, 2))).to(self.device)
+            img_original = torch.FloatTensor(np.transpose(img_original, (0, 3, 1, 2))).to(self.device)/255. # BGR -> RGB
 
-        torch.cuda.empty_cache()
-        for p, f, xf, c in zip(pred, frames, f_frames, coords):
-            y1, y2, x1, x2 = c
-            p = cv2.resize(p.astype(np.uint8), (x2 - x1, y2 - y1))
-            
-            ff = xf.copy() 
-            ff[y1:y2, x1:x2] = p
-            
-            # month region enhancement by GFPGAN
-            cropped_faces, restored_faces, restored_img = restorer.enhance(
-                ff, has_aligned=False, only_center_face=True, paste_back=True)
+            with torch.no_grad():
+                incomplete, reference = torch.split(img_batch, 3, dim=1)
+                pred, low_res = self.model(mel_batch, img_batch, reference)
+                pred = torch.clamp(pred, 0, 1)
+
+                if args.up_face in ['sad', 'angry', 'surprise']:
+                    tar_aus = exp_aus_dict[args.up_face]
+                else:
+                    pass
+
+                if args.up_face == 'original':
+                    cur_gen_faces = img_original
+                else:
+                    test_batch = {'src_img': torch.nn.functional.interpolate((img_original * 2 - 1), size=(128, 128), mode='bilinear'),
+                                  'tar_aus': tar_aus.repeat(len(incomplete), 1)}
+                    instance.feed_batch(test_batch)
+                    instance.forward()
+                    cur_gen_faces = torch.nn.functional.interpolate(instance.fake_img / 2. + 0.5, size=(384, 384), mode='bilinear')
+
+                if args.without_rl1 is not False:
+                    incomplete, reference = torch.split(img_batch, 3, dim=1)
+                    mask = torch.where(incomplete==0, torch.ones_like(incomplete), torch.zeros_like(incomplete))
+                    pred = pred * mask + cur_gen_faces * (1 - mask)
+
+            pred = pred.cpu().numpy().transpose(0, 2, 3, 1) * 255.
+
+            torch.cuda.empty_cache()
+            ffs = []
+            for p, xf, c in zip(pred, f_frames, coords):
+                y1, y2, x1, x2 = c
+                ff = xf.copy()
+                ff[y1:y2, x1:x2] = cv2.resize(p.astype(np.uint8), (x2 - x1, y2 - y1))
+                ffs.append(ff)
+
+            # month region enhancement by GFPGAN, the whole LNet batch at once
+            # with --aligned_enhance the faces are aligned with the Step 1 landmarks (lm5s) instead of detected again
+            _, _, restored_imgs = self.restorer.enhance_batch(ffs, has_aligned=False, only_center_face=True, paste_back=True,
+                                                              landmarks_5=lm5s)
                 # 0,   1,   2,   3,   4,   5,   6,   7,   8,  9, 10,  11,  12,
             mm = [0,   0,   0,   0,   0,   0,   0,   0,   0,  0, 255, 255, 255, 0, 0, 0, 0, 0, 0]
-            mouse_mask = np.zeros_like(restored_img)
-            tmp_mask = enhancer.faceparser.process(restored_img[y1:y2, x1:x2], mm)[0]
-            mouse_mask[y1:y2, x1:x2]= cv2.resize(tmp_mask, (x2 - x1, y2 - y1))[:, :, np.newaxis] / 255.
-
-            height, width = ff.shape[:2]
-            restored_img, ff, full_mask = [cv2.resize(x, (512, 512)) for x in (restored_img, ff, np.float32(mouse_mask))]
-            img = Laplacian_Pyramid_Blending_with_mask(restored_img, ff, full_mask[:, :, 0], 10)
-            pp = np.uint8(cv2.resize(np.clip(img, 0 ,255), (width, height)))
-pp, orig_faces, enhanced_faces = enhancer.process(pp, xf, bbox=c, face_enhance=True, possion_blending=False) 
-            out.write(pp)
-    out.release()
-    
-    if not os.path.isdir(os.path.dirname(args.outfile)):
-        os.makedirs(os.path.dirname(args.outfile), exist_ok=True)
-    command = 'ffmpeg -loglevel error -y -i {} -i {} -strict -2 -q:v 1 {}'.format(args.audio, 'temp/{}/result.mp4'.format(args.tmp_dir), args.outfile)
-    subprocess.call(command, shell=platform.system() != 'Windows')
-    print('outfile:', args.outfile)
-    return args.outfile
-
-
-# frames:256x256, full_frames: original size
-def datagen(frames, mels, full_frames, frames_pil, cox):
-    img_batch, mel_batch, frame_batch, coords_batch, ref_batch, full_frame_batch = [], [], [], [], [], []
-    base_name = args.face.split('/')[-1]
-    refs = []
-    image_size = 256 
-
-    # original frames
-    kp_extractor = KeypointExtractor()
-    fr_pil = [Image.fromarray(frame) for frame in frames]
-    lms = kp_extractor.extract_keypoint(fr_pil, 'temp/'+base_name+'x12_landmarks.txt')
-    frames_pil = [ (lm, frame) for frame,lm in zip(fr_pil, lms)] # frames is the croped version of modified face
-    crops, orig_images, quads  = crop_faces(image_size, frames_pil, scale=1.0, use_fa=True)
-    inverse_transforms = [calc_alignment_coefficients(quad + 0.5, [[0, 0], [0, image_size], [image_size, image_size], [image_size, 0]]) for quad in quads]
-    del kp_extractor.detector
-
-    oy1,oy2,ox1,ox2 = cox
-    face_det_results = face_detect(full_frames, args, jaw_correction=True)
-
-    for inverse_transform, crop, full_frame, face_det in zip(inverse_transforms, crops, full_frames, face_det_results):
-        imc_pil = paste_image(inverse_transform, crop, Image.fromarray(
-            cv2.resize(full_frame[int(oy1):int(oy2), int(ox1):int(ox2)], (256, 256))))
-
-        ff = full_frame.copy()
-        ff[int(oy1):int(oy2), int(ox1):int(ox2)] = cv2.resize(np.array(imc_pil.convert('RGB')), (ox2 - ox1, oy2 - oy1))
-        oface, coords = face_det
-        y1, y2, x1, x2 = coords
-        refs.append(ff[y1: y2, x1:x2])
-
-    for i, m in enumerate(mels):
-        idx = 0 if args.static else i % len(frames)
-        frame_to_save = frames[idx].copy()
-        face = refs[idx]
-        oface, coords = face_det_results[idx].copy()
-
-        face = cv2.resize(face, (args.img_size, args.img_size))
-        oface = cv2.resize(oface, (args.img_size, args.img_size))
-
-        img_batch.append(oface)
-        ref_batch.append(face) 
-        mel_batch.append(m)
-        coords_batch.append(coords)
-        frame_batch.append(frame_to_save)
-        full_frame_batch.append(full_frames[idx].copy())
-
-        if len(img_batch) >= args.LNet_batch_size:
+            # on the GPU the parser masks stay on the device and the batch is blended there, see blend_frames
+            on_device = self.device != 'cpu'
+            tmp_masks = self.enhancer.faceparser.process_batch(
+                [restored_img[y1:y2, x1:x2] for restored_img, (y1, y2, x1, x2) in zip(restored_imgs, coords)], mm, as_tensor=on_device)
+            height, width = ffs[0].shape[:2]
+            if on_device:
+                mouse_masks = torch.zeros(len(ffs), 1, height, width, device=self.device)
+            else:
+                mouse_masks = []
+            for k, (y1, y2, x1, x2) in enumerate(coords):
+                # the mouth mask is binary, only the pixels that stay 255 after the resize are kept
+                if on_device:
+                    tmp_mask = torch.nn.functional.interpolate(tmp_masks[k][None, None].float(), (y2 - y1, x2 - x1), mode='bilinear')
+                    mouse_masks[k, :, y1:y2, x1:x2] = (tmp_mask >= 254.5).float()
+                else:
+                    mouse_mask = np.zeros((height, width), np.uint8)
+                    mouse_mask[y1:y2, x1:x2] = cv2.resize(tmp_masks[k], (x2 - x1, y2 - y1)) / 255.
+                    mouse_masks.append(np.float32(mouse_mask))
+            pps = blend_frames(restored_imgs, ffs, mouse_masks, 10, size=(512, 512), device=self.device)
+
+            pps, orig_faces, enhanced_faces = self.enhancer.process_batch(pps, f_frames, bboxes=coords, face_enhance=True,
+                                                                          landmarks_5=lm5s)
+            for pp in pps:
+                out.write(pp)
+            pbar.update(len(pred))
+            report(args, 6, pbar.n / pbar.total)
+
+    # frames:256x256, full_frames: original size
+    # landmarks_5: optional full frame 5 landmarks of the frames, passed along to the enhancers
+    def datagen(self, args, frames, mels, full_frames, frames_pil, cox, face_coords=None, landmarks_5=None):
+        img_batch, mel_batch, frame_batch, coords_batch, ref_batch, full_frame_batch, lm5_batch = [], [], [], [], [], [], []
+        refs = []
+        image_size = 256
+
+        # original frames
+        fr_pil = [Image.fromarray(frame) for frame in frames]
+        lms = self.kp_extractor.extract_keypoint_batch(fr_pil, info=face_coords is None, batch_size=args.kp_batch_size,
+                                                      track_interval=args.track_interval)
+        frames_pil = [ (lm, frame) for frame,lm in zip(fr_pil, lms)] # frames is the croped version of modified face
+        crops, orig_images, quads  = crop_faces(image_size, frames_pil, scale=1.0, use_fa=True, fa=self.kp_extractor.detector)
+        inverse_transforms = [calc_alignment_coefficients(quad + 0.5, [[0, 0], [0, image_size], [image_size, image_size], [image_size, 0]]) for quad in quads]
+
+        oy1,oy2,ox1,ox2 = cox
+        if face_coords is None:
+            face_det_results = face_detect(full_frames, args, jaw_correction=True, detector=self.face_detector)
+        else:
+            face_det_results = [[full_frame[y1: y2, x1:x2], (y1, y2, x1, x2)] for full_frame, (y1, y2, x1, x2) in zip(full_frames, face_coords)]
+
+        for inverse_transform, crop, full_frame, face_det in zip(inverse_transforms, crops, full_frames, face_det_results):
+            imc_pil = paste_image(inverse_transform, crop, Image.fromarray(
+                cv2.resize(full_frame[int(oy1):int(oy2), int(ox1):int(ox2)], (256, 256))))
+
+            ff = full_frame.copy()
+            ff[int(oy1):int(oy2), int(ox1):int(ox2)] = cv2.resize(np.array(imc_pil.convert('RGB')), (ox2 - ox1, oy2 - oy1))
+            oface, coords = face_det
+            y1, y2, x1, x2 = coords
+            refs.append(ff[y1: y2, x1:x2])
+
+        for i, m in enumerate(mels):
+            idx = 0 if args.static else i % len(frames)
+            frame_to_save = frames[idx].copy()
+            face = refs[idx]
+            oface, coords = face_det_results[idx].copy()
+
+            face = cv2.resize(face, (args.img_size, args.img_size))
+            oface = cv2.resize(oface, (args.img_size, args.img_size))
+
+            img_batch.append(oface)
+            ref_batch.append(face)
+            mel_batch.append(m)
+            coords_batch.append(coords)
+            frame_batch.append(frame_to_save)
+            full_frame_batch.append(full_frames[idx].copy())
+            lm5_batch.append(landmarks_5[idx] if landmarks_5 is not None else None)
+
+            if len(img_batch) >= args.LNet_batch_size:
+                img_batch, mel_batch, ref_batch = np.asarray(img_batch), np.asarray(mel_batch), np.asarray(ref_batch)
+                img_masked = img_batch.copy()
+                img_original = img_batch.copy()
+                img_masked[:, args.img_size//2:] = 0
+                img_batch = np.concatenate((img_masked, ref_batch), axis=3) / 255.
+                mel_batch = np.reshape(mel_batch, [len(mel_batch), mel_batch.shape[1], mel_batch.shape[2], 1])
+
+                yield img_batch, mel_batch, frame_batch, coords_batch, img_original, full_frame_batch, lm5_batch
+                img_batch, mel_batch, frame_batch, coords_batch, img_original, full_frame_batch, ref_batch, lm5_batch  = [], [], [], [], [], [], [], []
+
+        if len(img_batch) > 0:
             img_batch, mel_batch, ref_batch = np.asarray(img_batch), np.asarray(mel_batch), np.asarray(ref_batch)
             img_masked = img_batch.copy()
             img_original = img_batch.copy()
             img_masked[:, args.img_size//2:] = 0
             img_batch = np.concatenate((img_masked, ref_batch), axis=3) / 255.
             mel_batch = np.reshape(mel_batch, [len(mel_batch), mel_batch.shape[1], mel_batch.shape[2], 1])
+            yield img_batch, mel_batch, frame_batch, coords_batch, img_original, full_frame_batch, lm5_batch
+
+
+def load_lnet_server(opt=None, device=None):
+    # one LNet/ENet for the pipelines of concurrent jobs, their Step 6 batches are fused up to --LNet_batch_size
+    opt = opt if opt is not None else options(['--face', '', '--audio', ''])
+    device = device or ('cuda' if torch.cuda.is_available() else 'cpu')
+    model = set_precision(load_network(opt, device).to(device), device, opt.precision, opt.channels_last)
+    return MicroBatcher(model, max_batch_size=opt.LNet_batch_size, max_latency=opt.max_batch_latency / 1000.)
+
+
+def report(args, step, progress=1.):
+    # step is the [Step N] number, progress the fraction of the step done
+    if getattr(args, 'progress', None) is not None:
+        args.progress(step, progress)
+
+
+def crop_region(crop, quad, frame_shape):
+    clx, cly, crx, cry = crop
+    lx, ly, rx, ry = quad
+    lx, ly, rx, ry = int(lx), int(ly), int(rx), int(ry)
+    oy1, oy2, ox1, ox2 = cly+ly, min(cly+ry, frame_shape[0]), clx+lx, min(clx+rx, frame_shape[1])
+    return oy1, oy2, ox1, ox2
+
+
+def to_frames_pil(croper, full_frames, crop, quad):
+    full_frames_RGB = [cv2.cvtColor(frame, cv2.COLOR_BGR2RGB) for frame in full_frames]
+    full_frames_RGB = croper.apply_crop(full_frames_RGB, crop, quad)
+    return [Image.fromarray(cv2.resize(frame,(256,256))) for frame in full_frames_RGB]
+
 
-            yield img_batch, mel_batch, frame_batch, coords_batch, img_original, full_frame_batch
-            img_batch, mel_batch, frame_batch, coords_batch, img_original, full_frame_batch, ref_batch  = [], [], [], [], [], [], []
-
-    if len(img_batch) > 0:
-        img_batch, mel_batch, ref_batch = np.asarray(img_batch), np.asarray(mel_batch), np.asarray(ref_batch)
-        img_masked = img_batch.copy()
-        img_original = img_batch.copy()
-        img_masked[:, args.img_size//2:] = 0
-        img_batch = np.concatenate((img_masked, ref_batch), axis=3) / 255.
-        mel_batch = np.reshape(mel_batch, [len(mel_batch), mel_batch.shape[1], mel_batch.shape[2], 1])
-        yield img_batch, mel_batch, frame_batch, coords_batch, img_original, full_frame_batch
+def main():
+    args = options()
+    pipeline = Pipeline(args)
+    return pipeline.run(args.face, args.audio)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,142 @@
+import os
+import time
+import uuid
+import queue
+import threading
+import traceback
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+# the steps of inference.Pipeline, reported through its progress callback
+STEPS = ['Face cropping', 'Landmarks extraction', '3DMM extraction', 'Expression stabilization',
+         'Audio loading', 'Reference enhancement', 'Lip synthesis']
+
+
+def max_workers(memory_per_job, requested=None):
+    """Number of jobs that can run at once, bounded by the cores and the available memory."""
+    workers = os.cpu_count() or 1
+    try:
+        available = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+        workers = min(workers, max(1, int(available // memory_per_job)))
+    except (ValueError, OSError, AttributeError):
+        pass
+    if requested is not None:
+        workers = min(workers, requested)
+    return max(1, workers)
+
+
+class Job:
+    def __init__(self, params):
+        self.id = uuid.uuid4().hex
+        self.params = params
+        self.status = 'queued'
+        self.step, self.step_progress = None, 0.
+        self.result, self.error = None, None
+        self.created, self.started, self.finished = time.time(), None, None
+        self.future = Future()
+
+    def update(self, step, progress=1.):
+        # progress callback of Pipeline.run
+        self.step, self.step_progress = step, progress
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'status': self.status,
+            'step': self.step,
+            'step_name': STEPS[self.step] if self.step is not None else None,
+            'step_progress': round(self.step_progress, 3),
+            'progress': round((self.step + self.step_progress) / len(STEPS), 3) if self.step is not None else 0.,
+            'result': self.result,
+            'error': self.error,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+        }
+
+
+class JobQueue:
+    """In-memory job queue served by a fixed number of worker threads.
+
+    Every worker builds its own context once (e.g. a warm ``inference.Pipeline``) and runs
+    ``handler(context, job)`` for one queued job at a time. The latest ``max_jobs`` jobs are kept for
+    status queries.
+    """
+
+    def __init__(self, handler, workers=1, max_jobs=1000):
+        self.handler = handler
+        self.workers = workers
+        self.max_jobs = max_jobs
+        self.jobs = OrderedDict()
+        self.pending = queue.Queue()
+        self.lock = threading.Lock()
+        self.threads = []
+        self.failed_workers, self.startup_error = 0, None
+
+    def start(self, make_context):
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._work, args=(make_context,), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, **params):
+        job = Job(params)
+        with self.lock:
+            self.jobs[job.id] = job
+            # forget the oldest finished jobs, queued and running ones stay queryable
+            finished = [job_id for job_id, other in self.jobs.items() if other.status in ('done', 'failed')]
+            for job_id in finished[:max(0, len(self.jobs) - self.max_jobs)]:
+                del self.jobs[job_id]
+        self.pending.put(job)
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def position(self, job):
+        # number of queued jobs submitted before job
+        with self.lock:
+            return sum(1 for other in self.jobs.values() if other.status == 'queued' and other.created < job.created)
+
+    def _work(self, make_context):
+        try:
+            context = make_context()
+        except Exception as e:
+            traceback.print_exc()
+            self._fail_worker(e)
+            return
+        while True:
+            job = self.pending.get()
+            self._run(job, context)
+
+    def _run(self, job, context):
+        job.status, job.started = 'running', time.time()
+        try:
+            job.result = self.handler(context, job)
+            job.status = 'done'
+            job.future.set_result(job.result)
+        except Exception as e:
+            job.error, job.status = str(e), 'failed'
+            job.future.set_exception(e)
+        finally:
+            job.finished = time.time()
+            self.pending.task_done()
+
+    def _fail_worker(self, error):
+        # a worker could not build its context (e.g. a missing checkpoint); once no worker is left the
+        # pending and later jobs fail instead of staying queued forever
+        with self.lock:
+            self.failed_workers += 1
+            self.startup_error = error
+            alive = self.workers - self.failed_workers
+        if alive > 0:
+            return
+        while True:
+            job = self.pending.get()
+            job.status, job.started = 'failed', time.time()
+            job.error = 'worker failed to start: {}'.format(error)
+            job.future.set_exception(RuntimeError(job.error))
+            job.finished = time.time()
+            self.pending.task_done()
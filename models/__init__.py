@@ -1,7 +1,9 @@
+import os
 import torch
 from models.DNet import DNet
 from models.LNet import LNet
 from models.ENet import ENet
+from models.prepare import prepare_for_inference
 
 
 def _load(checkpoint_path):
@@ -22,16 +24,92 @@ def load_checkpoint(path, model):
     model.load_state_dict(new_s, strict=False)
     return model
 
-def load_network(args):
+def load_network(args, device='cpu'):
+    # device only selects the execution provider of the exports, the torch models are moved by the caller
+    if getattr(args, 'backend', 'torch') != 'torch':
+        return load_exported(args, 'ENet', device)
     L_net = LNet()
     L_net = load_checkpoint(args.LNet_path, L_net)
     E_net = ENet(lnet=L_net)
     model = load_checkpoint(args.ENet_path, E_net)
-    return model.eval()
+    # mel, masked face + reference, reference
+    example_inputs = (torch.randn(1, 1, 80, 16), torch.rand(1, 6, 384, 384), torch.rand(1, 3, 384, 384)) \
+        if getattr(args, 'check_prepare', False) else None
+    return prepare_for_inference(model.eval(), example_inputs)
 
-def load_DNet(args):
+def load_DNet(args, device='cpu'):
+    # device only selects the execution provider of the exports, the torch models are moved by the caller
+    if getattr(args, 'backend', 'torch') != 'torch':
+        return load_exported(args, 'DNet', device)
     D_Net = DNet()
     print("Load checkpoint from: {}".format(args.DNet_path))
     checkpoint =  torch.load(args.DNet_path, map_location=lambda storage, loc: storage)
     D_Net.load_state_dict(checkpoint['net_G_ema'], strict=False)
-    return D_Net.eval()
\ No newline at end of file
+    # source image, window of 3dmm coeffs
+    example_inputs = (torch.rand(1, 3, 256, 256) * 2 - 1, torch.randn(1, 73, 27)) \
+        if getattr(args, 'check_prepare', False) else None
+    return prepare_for_inference(D_Net.eval(), example_inputs)
+
+
+# the outputs of the exported models given back like the original models return them, see models.export
+_output_formats = {
+    'ENet': tuple,                                      # pred, low_res
+    'DNet': lambda outputs: {'fake_image': outputs[0]},
+    'GPEN-BFR-512': lambda outputs: (outputs[0], None), # image, latent
+    'ParseNet': tuple,                                  # mask, image
+}
+
+def load_exported(args, name, device='cpu'):
+    # --backend onnx or torchscript: the model exported by models.export to --export_dir
+    extension = {'onnx': '.onnx', 'torchscript': '.pt'}[args.backend]
+    path = os.path.join(args.export_dir, name + extension)
+    print("Load exported model from: {}".format(path))
+    return ExportedModel(path, _output_formats[name], device)
+
+
+class ExportedModel(torch.nn.Module):
+    """Drop-in for a model exported to ONNX or TorchScript, called with and returning torch tensors.
+
+    ONNX models run in an ONNX Runtime session with all the graph optimizations. Models exported with a
+    fixed batch size (see models.export) run the inputs in chunks of that size.
+    """
+
+    def __init__(self, path, output_format=tuple, device='cpu'):
+        super(ExportedModel, self).__init__()
+        self.output_format = output_format
+        self.session, self.module = None, None
+        if path.endswith('.onnx'):
+            import onnxruntime as ort
+            options = ort.SessionOptions()
+            options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+            providers = ['CPUExecutionProvider'] if str(device) == 'cpu' else ['CUDAExecutionProvider', 'CPUExecutionProvider']
+            self.session = ort.InferenceSession(path, options, providers=providers)
+            self.input_names = [i.name for i in self.session.get_inputs()]
+            batch_size = self.session.get_inputs()[0].shape[0]
+            self.batch_size = batch_size if isinstance(batch_size, int) else None
+        else:
+            extra_files = {'batch_size': ''}
+            self.module = torch.jit.load(path, map_location=device, _extra_files=extra_files)
+            self.batch_size = int(extra_files['batch_size']) if extra_files['batch_size'] else None
+
+    def forward(self, *inputs):
+        n = inputs[0].shape[0]
+        if self.batch_size is None or n == self.batch_size:
+            return self.output_format(self.run(inputs))
+        chunks = []
+        for start in range(0, n, self.batch_size):
+            chunk = [x[start:start + self.batch_size] for x in inputs]
+            pad = self.batch_size - chunk[0].shape[0]
+            if pad > 0: # repeat the last sample up to the exported batch size
+                chunk = [torch.cat([x] + [x[-1:]] * pad, 0) for x in chunk]
+            chunks.append([o[:self.batch_size - pad] for o in self.run(chunk)])
+        return self.output_format([torch.cat(outputs, 0) for outputs in zip(*chunks)])
+
+    def run(self, inputs):
+        if self.module is not None:
+            with torch.no_grad():
+                outputs = self.module(*inputs)
+            return list(outputs) if isinstance(outputs, (list, tuple)) else [outputs]
+        device = inputs[0].device
+        feeds = {name: x.detach().float().cpu().numpy() for name, x in zip(self.input_names, inputs)}
+        return [torch.from_numpy(o).to(device) for o in self.session.run(None, feeds)]
@@ -60,6 +60,11 @@ class LayerNorm2d(nn.Module):
           self.bias = nn.Parameter(torch.zeros(n_out, 1, 1))
 
     def forward(self, x):
+        # fp32 under fp16/bf16 autocast
+        with torch.autocast(x.device.type, enabled=False):
+            return self._forward(x.float())
+
+    def _forward(self, x):
         normalized_shape = x.size()[1:]
         if self.affine:
           return F.layer_norm(x, normalized_shape, \
@@ -484,7 +489,13 @@ class ModulatedConv2d(nn.Module):
             math.sqrt(in_channels * kernel_size**2))
         self.padding = kernel_size // 2
 
+    def prepare_for_inference(self):
+        # the squared weights summed over the kernel, the demodulation then only needs the style
+        self.register_buffer('weight_sq', self.weight.detach().pow(2).sum([3, 4]), persistent=False)  # (1, out, in)
+
     def forward(self, x, style):
+        if hasattr(self, 'weight_sq'):
+            return self.forward_prepared(x, style)
         b, c, h, w = x.shape   
         style = self.modulation(style).view(b, 1, c, 1, 1)
         weight = self.weight * style  
@@ -507,6 +518,22 @@ class ModulatedConv2d(nn.Module):
         out = out.view(b, self.out_channels, *out.shape[2:4])
         return out
 
+    def forward_prepared(self, x, style):
+        # same result as forward: the style scales the input channels and the demodulation the output
+        # channels of a single conv shared by the whole batch, instead of a grouped conv with per-sample weights
+        b, c, h, w = x.shape
+        style = self.modulation(style)
+        if self.sample_mode == 'upsample':
+            x = F.interpolate(x, scale_factor=2, mode='bilinear', align_corners=False)
+        elif self.sample_mode == 'downsample':
+            x = F.interpolate(x, scale_factor=0.5, mode='bilinear', align_corners=False)
+
+        out = F.conv2d(x * style.view(b, c, 1, 1), self.weight[0], padding=self.padding)
+        if self.demodulate:
+            demod = torch.rsqrt(style.pow(2) @ self.weight_sq[0].t() + self.eps)  # (b, out)
+            out = out * demod.view(b, self.out_channels, 1, 1)
+        return out
+
     def __repr__(self):
         return (f'{self.__class__.__name__}(in_channels={self.in_channels}, out_channels={self.out_channels}, '
                 f'kernel_size={self.kernel_size}, demodulate={self.demodulate}, sample_mode={self.sample_mode})')
@@ -526,8 +553,7 @@ class StyleConv(nn.Module):
         out = self.modulated_conv(x, style) * 2**0.5  # for conversion
         # noise injection
         if noise is None:
-            b, _, h, w = out.shape
-            noise = out.new_empty(b, 1, h, w).normal_()
+            noise = torch.randn_like(out[:, :1])  # exports as RandomNormalLike, with a dynamic batch
         out = out + self.weight * noise
         # add bias
         out = out + self.bias
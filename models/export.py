@@ -0,0 +1,99 @@
+"""Export LNet/ENet, DNet, GPEN and the face parser to ONNX or TorchScript for --backend onnx/torchscript.
+
+    python -m models.export --format onnx --export_dir checkpoints/exported
+
+The models are exported on the CPU after prepare_for_inference, with a dynamic batch axis. GPEN keeps
+grouped modulated convs with the batch as the number of groups, it is exported with a fixed batch size
+(--gpen_batch_size) and models.ExportedModel runs larger batches in chunks.
+"""
+import os
+import sys
+import argparse
+import torch
+
+sys.path.insert(0, 'third_part')
+sys.path.insert(0, 'third_part/GPEN')
+
+from models import load_network, load_DNet
+from models.ffc import FourierUnit
+
+
+class _Outputs(torch.nn.Module):
+    # the tensor outputs of a model as a tuple, in the order of models._output_formats
+    def __init__(self, model, select):
+        super(_Outputs, self).__init__()
+        self.model = model
+        self.select = select
+
+    def forward(self, *inputs):
+        return self.select(self.model(*inputs))
+
+
+def export_specs(args):
+    # name: (model, example inputs, input names, output names, dynamic batch)
+    from face_model.face_gan import FaceGAN
+    from face_parse.face_parsing import FaceParse
+    specs = {}
+    if 'ENet' in args.models:
+        specs['ENet'] = (_Outputs(load_network(args), lambda out: out),
+                         (torch.randn(2, 1, 80, 16), torch.rand(2, 6, 384, 384), torch.rand(2, 3, 384, 384)),
+                         ['mel', 'face', 'reference'], ['pred', 'low_res'], True)
+    if 'DNet' in args.models:
+        specs['DNet'] = (_Outputs(load_DNet(args), lambda out: (out['fake_image'],)),
+                         (torch.rand(2, 3, 256, 256) * 2 - 1, torch.randn(2, 73, 27)),
+                         ['source_image', 'coeffs'], ['fake_image'], True)
+    if 'GPEN-BFR-512' in args.models:
+        gpen = FaceGAN('checkpoints', 512, 'GPEN-BFR-512', 2, 1, device='cpu').model
+        specs['GPEN-BFR-512'] = (_Outputs(gpen, lambda out: (out[0],)),
+                                 (torch.rand(args.gpen_batch_size, 3, 512, 512) * 2 - 1,),
+                                 ['face'], ['image'], False)
+    if 'ParseNet' in args.models:
+        parsenet = FaceParse('checkpoints', device='cpu').faceparse
+        specs['ParseNet'] = (_Outputs(parsenet, lambda out: tuple(out)), (torch.rand(2, 3, 512, 512) * 2 - 1,),
+                             ['face'], ['mask', 'image'], True)
+    return specs
+
+
+def export_onnx(model, inputs, input_names, output_names, dynamic_batch, path, opset):
+    dynamic_axes = {name: {0: 'batch'} for name in input_names + output_names} if dynamic_batch else None
+    torch.onnx.export(model, inputs, path, input_names=input_names, output_names=output_names,
+                      dynamic_axes=dynamic_axes, opset_version=opset, do_constant_folding=True)
+
+
+def export_torchscript(model, inputs, dynamic_batch, path):
+    # the random noise of ENet makes the outputs of two traces differ, skip the trace check
+    traced = torch.jit.trace(model, inputs, check_trace=False)
+    extra_files = {'batch_size': '' if dynamic_batch else str(inputs[0].shape[0])}
+    torch.jit.save(torch.jit.freeze(traced.eval()), path, _extra_files=extra_files)
+
+
+def main():
+    from utils.inference_utils import options
+    parser = argparse.ArgumentParser(description='Export the models for --backend onnx/torchscript')
+    parser.add_argument('--format', type=str, default='onnx', choices=['onnx', 'torchscript'])
+    parser.add_argument('--models', nargs='+', default=['ENet', 'DNet', 'GPEN-BFR-512', 'ParseNet'])
+    parser.add_argument('--opset', type=int, default=16, help='ONNX opset, GridSample in DNet needs 16')
+    parser.add_argument('--gpen_batch_size', type=int, default=1)
+    export_args, remaining = parser.parse_known_args()
+    # checkpoint paths and --export_dir from the inference options
+    args = options(['--face', '', '--audio', ''] + remaining)
+    args.backend = 'torch'
+    for key, value in vars(export_args).items():
+        setattr(args, key, value)
+
+    os.makedirs(args.export_dir, exist_ok=True)
+    FourierUnit.dft_matmul = args.format == 'onnx'
+    with torch.no_grad():
+        for name, (model, inputs, input_names, output_names, dynamic_batch) in export_specs(args).items():
+            model = model.eval()
+            if args.format == 'onnx':
+                path = os.path.join(args.export_dir, name + '.onnx')
+                export_onnx(model, inputs, input_names, output_names, dynamic_batch, path, args.opset)
+            else:
+                path = os.path.join(args.export_dir, name + '.pt')
+                export_torchscript(model, inputs, dynamic_batch, path)
+            print('[Info] exported {} to {}'.format(name, path))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,7 @@
 # original implementation https://github.com/pkumivision/FFC/blob/main/model_zoo/ffc.py
 # paper https://proceedings.neurips.cc/paper/2020/file/2fd5d41ec6cfab47e32164d5624269b1-Paper.pdf
 
+import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -59,7 +60,47 @@ class FFCSE_block(nn.Module):
         return x_l, x_g
 
 
+def _dft_matrices(n, m, device, dtype):
+    # cos/sin of the DFT of length n for the frequencies 0..m-1, (n, m)
+    k = torch.arange(n, device=device, dtype=torch.float64)
+    angle = 2 * math.pi * k[:, None] * torch.arange(m, device=device, dtype=torch.float64)[None] / n
+    return torch.cos(angle).to(dtype), torch.sin(angle).to(dtype)
+
+
+def _fft_scales(h, w, norm):
+    forward = {'ortho': (h * w) ** -0.5, 'backward': 1., 'forward': 1. / (h * w)}[norm]
+    return forward, 1. / (h * w * forward)
+
+
+def rfft2_matmul(x, norm='ortho'):
+    """torch.fft.rfftn over the last two dims of a real tensor written as matmuls with DFT matrices, for exporters
+    without FFT ops. Returns the real and imaginary parts."""
+    h, w = x.shape[-2:]
+    cos_w, sin_w = _dft_matrices(w, w // 2 + 1, x.device, x.dtype)
+    cos_h, sin_h = _dft_matrices(h, h, x.device, x.dtype)
+    scale, _ = _fft_scales(h, w, norm)
+    real, imag = x @ cos_w, -(x @ sin_w)
+    return (cos_h @ real + sin_h @ imag) * scale, (cos_h @ imag - sin_h @ real) * scale
+
+
+def irfft2_matmul(real, imag, size, norm='ortho'):
+    """torch.fft.irfftn(s=size) over the last two dims, see rfft2_matmul."""
+    h, w = size
+    cos_h, sin_h = _dft_matrices(h, h, real.device, real.dtype)
+    cos_w, sin_w = _dft_matrices(w, w // 2 + 1, real.device, real.dtype)
+    _, scale = _fft_scales(h, w, norm)
+    real, imag = cos_h @ real - sin_h @ imag, cos_h @ imag + sin_h @ real
+    # c2r: the frequencies 1..(w-1)//2 stand for their conjugates too
+    weight = torch.full((w // 2 + 1,), 2., device=real.device, dtype=real.dtype)
+    weight[0] = 1.
+    if w % 2 == 0:
+        weight[-1] = 1.
+    return ((real * weight) @ cos_w.t() - (imag * weight) @ sin_w.t()) * scale
+
+
 class FourierUnit(nn.Module):
+    # compute the FFT with DFT matmuls, set by models.export, also used while exporting to ONNX
+    dft_matmul = False
 
     def __init__(self, in_channels, out_channels, groups=1, spatial_scale_factor=None, spatial_scale_mode='bilinear',
                  spectral_pos_encoding=False, use_se=False, se_kwargs=None, ffc3d=False, fft_norm='ortho'):
@@ -87,6 +128,11 @@ class FourierUnit(nn.Module):
         self.fft_norm = fft_norm
 
     def forward(self, x):
+        # the FFT and the spectral conv stay in fp32 under fp16/bf16 autocast
+        with torch.autocast(x.device.type, enabled=False):
+            return self._forward(x.float().contiguous())
+
+    def _forward(self, x):
         batch = x.shape[0]
 
         if self.spatial_scale_factor is not None:
@@ -96,9 +142,13 @@ class FourierUnit(nn.Module):
         r_size = x.size()
         # (batch, c, h, w/2+1, 2)
         fft_dim = (-3, -2, -1) if self.ffc3d else (-2, -1)
-        ffted = torch.fft.rfftn(x, dim=fft_dim, norm=self.fft_norm)
-        ffted = torch.stack((ffted.real, ffted.imag), dim=-1)
-        ffted = ffted.permute(0, 1, 4, 2, 3).contiguous()  # (batch, c, 2, h, w/2+1)
+        dft_matmul = (FourierUnit.dft_matmul or torch.onnx.is_in_onnx_export()) and not self.ffc3d
+        if dft_matmul:
+            ffted = torch.stack(rfft2_matmul(x, self.fft_norm), dim=2)  # (batch, c, 2, h, w/2+1)
+        else:
+            ffted = torch.fft.rfftn(x, dim=fft_dim, norm=self.fft_norm)
+            ffted = torch.stack((ffted.real, ffted.imag), dim=-1)
+            ffted = ffted.permute(0, 1, 4, 2, 3).contiguous()  # (batch, c, 2, h, w/2+1)
         ffted = ffted.view((batch, -1,) + ffted.size()[3:])
 
         if self.spectral_pos_encoding:
@@ -113,12 +163,15 @@ class FourierUnit(nn.Module):
         ffted = self.conv_layer(ffted)  # (batch, c*2, h, w/2+1)
         ffted = self.relu(self.bn(ffted))
 
-        ffted = ffted.view((batch, -1, 2,) + ffted.size()[2:]).permute(
-            0, 1, 3, 4, 2).contiguous()  # (batch,c, t, h, w/2+1, 2)
-        ffted = torch.complex(ffted[..., 0], ffted[..., 1])
-
         ifft_shape_slice = x.shape[-3:] if self.ffc3d else x.shape[-2:]
-        output = torch.fft.irfftn(ffted, s=ifft_shape_slice, dim=fft_dim, norm=self.fft_norm)
+        if dft_matmul:
+            ffted = ffted.view((batch, -1, 2,) + ffted.size()[2:])
+            output = irfft2_matmul(ffted[:, :, 0], ffted[:, :, 1], ifft_shape_slice, self.fft_norm)
+        else:
+            ffted = ffted.view((batch, -1, 2,) + ffted.size()[2:]).permute(
+                0, 1, 3, 4, 2).contiguous()  # (batch,c, t, h, w/2+1, 2)
+            ffted = torch.complex(ffted[..., 0], ffted[..., 1])
+            output = torch.fft.irfftn(ffted, s=ifft_shape_slice, dim=fft_dim, norm=self.fft_norm)
 
         if self.spatial_scale_factor is not None:
             output = F.interpolate(output, size=orig_size, mode=self.spatial_scale_mode, align_corners=False)
@@ -0,0 +1,74 @@
+import copy
+import torch
+import torch.nn as nn
+from torch.nn.utils import remove_spectral_norm
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+from models.ffc import FourierUnit
+from models.base_blocks import ModulatedConv2d
+
+
+def _remove_spectral_norms(model):
+    # bake weight_orig / sigma into a plain weight, eval mode does no power iteration so the result is the same
+    for module in model.modules():
+        for hook in list(module._forward_pre_hooks.values()):
+            if type(hook).__name__ == 'SpectralNorm':
+                remove_spectral_norm(module, name=hook.name)
+
+
+def _fold_batch_norms(model):
+    # Conv2d followed by BatchNorm2d in a Sequential, and the spectral conv + bn of the Fourier units
+    for module in model.modules():
+        if isinstance(module, nn.Sequential):
+            for i in range(len(module) - 1):
+                conv, bn = module[i], module[i + 1]
+                if type(conv) == nn.Conv2d and type(bn) == nn.BatchNorm2d and bn.track_running_stats:
+                    module[i], module[i + 1] = fuse_conv_bn_eval(conv, bn), nn.Identity()
+        elif isinstance(module, FourierUnit) and type(module.bn) == nn.BatchNorm2d and module.bn.track_running_stats:
+            module.conv_layer, module.bn = fuse_conv_bn_eval(module.conv_layer, module.bn), nn.Identity()
+
+
+def prepare_for_inference(model, example_inputs=None, atol=1e-3):
+    """Folds the inference-time constants of an eval model into its weights.
+
+    Spectral norms are baked into plain weights, BatchNorm is fused into the preceding conv and the
+    modulated convs precompute their demodulation weights. With ``example_inputs`` the outputs of the
+    prepared model are compared to the original ones and a RuntimeError is raised if they differ by more
+    than ``atol``.
+    """
+    model.eval()
+    original = copy.deepcopy(model) if example_inputs is not None else None
+
+    _remove_spectral_norms(model)
+    _fold_batch_norms(model)
+    for module in model.modules():
+        if isinstance(module, ModulatedConv2d):
+            module.prepare_for_inference()
+    for param in model.parameters():
+        param.requires_grad_(False)
+
+    if original is not None:
+        diff = max_difference(original, model, example_inputs)
+        print('[Info] {} prepared for inference, max output difference: {:.2e}'.format(type(model).__name__, diff))
+        if diff > atol:
+            raise RuntimeError('{} differs from the original model after folding ({:.2e} > {:.2e})'.format(
+                type(model).__name__, diff, atol))
+    return model
+
+
+def max_difference(model_a, model_b, inputs):
+    # the noise injections draw random numbers, both models see the same ones
+    outputs = []
+    for model in (model_a, model_b):
+        torch.manual_seed(0)
+        with torch.no_grad():
+            outputs.append(_flatten(model(*inputs)))
+    return max((a.float() - b.float()).abs().max().item() for a, b in zip(*outputs))
+
+
+def _flatten(out):
+    if torch.is_tensor(out):
+        return [out]
+    if isinstance(out, dict):
+        out = list(out.values())
+    return [t for o in out for t in _flatten(o)] if isinstance(out, (list, tuple)) else []
@@ -0,0 +1,28 @@
+import sys
+import os
+
+import pytest
+
+np = pytest.importorskip('numpy')
+torch = pytest.importorskip('torch')
+pytest.importorskip('librosa')
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from utils import audio
+from utils.hparams import hparams as hp
+
+
+@pytest.mark.skipif(hp.use_lws, reason='the torch path replaces the librosa stft')
+def test_mel_torch_matches_librosa():
+    rng = np.random.RandomState(0)
+    # not a multiple of the hop size, and loud edges so the padding of the first and last frames matters
+    y = rng.uniform(-1, 1, int(16000 * 1.37)).astype(np.float32)
+
+    expected = audio._linear_to_mel(np.abs(audio._stft(y)))
+    mel = audio._mel_torch(y, 'cpu')
+
+    assert mel.shape == expected.shape
+    atol = 1e-4 * np.abs(expected).max()
+    np.testing.assert_allclose(mel[:, 0], expected[:, 0], rtol=1e-4, atol=atol)
+    np.testing.assert_allclose(mel[:, -1], expected[:, -1], rtol=1e-4, atol=atol)
+    np.testing.assert_allclose(mel, expected, rtol=1e-4, atol=atol)
@@ -0,0 +1,59 @@
+import sys
+import os
+from types import SimpleNamespace
+
+import pytest
+
+np = pytest.importorskip('numpy')
+torch = pytest.importorskip('torch')
+pytest.importorskip('face_alignment')
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from third_part.face3d.extract_kp_videos import KeypointExtractor
+
+
+def _extractor(heatmaps):
+    # KeypointExtractor around a FAN that returns the given (68, 64, 64) heatmap for every crop
+    extractor = KeypointExtractor.__new__(KeypointExtractor)
+    extractor.detector = SimpleNamespace(
+        device='cpu',
+        face_detector=SimpleNamespace(reference_scale=195),
+        face_alignment_net=lambda inp: heatmaps[None].expand(len(inp), -1, -1, -1).clone())
+    return extractor
+
+
+def test_fan_landmarks_and_scores():
+    heatmaps = torch.zeros(68, 64, 64)
+    heatmaps[:, 32, 20] = 0.8
+    frames = np.zeros((3, 256, 256, 3), np.uint8)
+    boxes = [np.array([60., 60., 200., 200., 1.]), None, np.array([40., 50., 180., 210., 1.])]
+
+    landmarks, scores = _extractor(heatmaps)._fan(frames, boxes)
+
+    assert landmarks.shape == (3, 68, 2)
+    assert np.all(landmarks[1] == -1) and scores[1] == 0
+    for i in (0, 2):
+        assert np.all(landmarks[i] != -1)
+        assert scores[i] == pytest.approx(0.8)
+
+
+def test_detect_without_face():
+    extractor = _extractor(torch.zeros(68, 64, 64))
+    extractor.detector.face_detector.detect_from_image = lambda image: []
+
+    landmarks, box, score = extractor.detect(np.zeros((256, 256, 3), np.uint8))
+
+    assert np.all(landmarks == -1) and box is None and score == 0.
+
+
+def test_detect_with_box():
+    heatmaps = torch.zeros(68, 64, 64)
+    heatmaps[:, 30, 30] = 0.9
+    extractor = _extractor(heatmaps)
+    face = np.array([60., 60., 200., 200., 0.99])
+    extractor.detector.face_detector.detect_from_image = lambda image: [face]
+
+    landmarks, box, score = extractor.detect(np.zeros((256, 256, 3), np.uint8))
+
+    assert landmarks.shape == (68, 2) and np.all(landmarks != -1)
+    assert box is face and score == pytest.approx(0.9)
@@ -1,8 +1,11 @@
 import cv2
+import numpy as np
 import os
+import threading
 import torch
 from basicsr.utils import img2tensor, tensor2img
 from basicsr.utils.download_util import load_file_from_url
+from facexlib.utils import face_restoration_helper
 from facexlib.utils.face_restoration_helper import FaceRestoreHelper
 from torchvision.transforms.functional import normalize
 
@@ -13,6 +16,31 @@ from gfpgan.archs.gfpganv1_clean_arch import GFPGANv1Clean
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 
+_face_helper_lock = threading.Lock()
+
+
+def _face_helper(upscale, face_det, device):
+    # FaceRestoreHelper always loads its own detector, with face_det it gets the given one instead
+    def build():
+        return FaceRestoreHelper(
+            upscale,
+            face_size=512,
+            crop_ratio=(1, 1),
+            det_model='retinaface_resnet50',
+            save_ext='png',
+            device=device)
+
+    if face_det is None:
+        return build()
+    with _face_helper_lock:
+        init_detection_model = face_restoration_helper.init_detection_model
+        face_restoration_helper.init_detection_model = lambda *args, **kwargs: face_det
+        try:
+            return build()
+        finally:
+            face_restoration_helper.init_detection_model = init_detection_model
+
+
 class GFPGANer():
     """Helper for restoration with GFPGAN.
 
@@ -27,9 +55,11 @@ class GFPGANer():
         arch (str): The GFPGAN architecture. Option: clean | original. Default: clean.
         channel_multiplier (int): Channel multiplier for large networks of StyleGAN2. Default: 2.
         bg_upsampler (nn.Module): The upsampler for the background. Default: None.
+        face_det (nn.Module): A retinaface_resnet50 detector of facexlib to use instead of loading one,
+            e.g. shared by several GFPGANers. Default: None.
     """
 
-    def __init__(self, model_path, upscale=2, arch='clean', channel_multiplier=2, bg_upsampler=None):
+    def __init__(self, model_path, upscale=2, arch='clean', channel_multiplier=2, bg_upsampler=None, face_det=None):
         self.upscale = upscale
         self.bg_upsampler = bg_upsampler
 
@@ -73,13 +103,7 @@ class GFPGANer():
                 narrow=1,
                 sft_half=True)
         # initialize face helper
-        self.face_helper = FaceRestoreHelper(
-            upscale,
-            face_size=512,
-            crop_ratio=(1, 1),
-            det_model='retinaface_resnet50',
-            save_ext='png',
-            device=self.device)
+        self.face_helper = _face_helper(upscale, face_det, self.device)
 
         if model_path.startswith('https://'):
             model_path = load_file_from_url(
@@ -141,3 +165,72 @@ class GFPGANer():
             return self.face_helper.cropped_faces, self.face_helper.restored_faces, restored_img
         else:
             return self.face_helper.cropped_faces, self.face_helper.restored_faces, None
+
+    @torch.no_grad()
+    def enhance_batch(self, imgs, has_aligned=False, only_center_face=False, paste_back=True, landmarks_5=None):
+        """Batched version of ``enhance``, the faces of all the images are restored in a single forward pass.
+
+        ``landmarks_5`` optionally gives the (5, 2) landmarks of the face of every image (eyes, nose, mouth
+        corners), the face detection is skipped for the images where they are not None.
+        Returns lists with one entry per input image: cropped faces, restored faces and restored image.
+        """
+        if landmarks_5 is None:
+            landmarks_5 = [None] * len(imgs)
+        # detect and align the faces of every image, keeping the per-image helper state for pasting back
+        all_cropped_faces, all_affine_matrices = [], []
+        for img, landmarks in zip(imgs, landmarks_5):
+            self.face_helper.clean_all()
+            if has_aligned:
+                self.face_helper.cropped_faces = [cv2.resize(img, (512, 512))]
+            else:
+                self.face_helper.read_image(img)
+                if landmarks is not None:
+                    self.face_helper.all_landmarks_5 = [np.asarray(landmarks, dtype=np.float32)]
+                else:
+                    self.face_helper.get_face_landmarks_5(only_center_face=only_center_face, eye_dist_threshold=5)
+                self.face_helper.align_warp_face()
+            all_cropped_faces.append(self.face_helper.cropped_faces)
+            all_affine_matrices.append(self.face_helper.affine_matrices)
+
+        # face restoration
+        cropped_faces = [face for faces in all_cropped_faces for face in faces]
+        restored_faces = []
+        if len(cropped_faces) > 0:
+            cropped_faces_t = []
+            for cropped_face in cropped_faces:
+                cropped_face_t = img2tensor(cropped_face / 255., bgr2rgb=True, float32=True)
+                normalize(cropped_face_t, (0.5, 0.5, 0.5), (0.5, 0.5, 0.5), inplace=True)
+                cropped_faces_t.append(cropped_face_t)
+            cropped_faces_t = torch.stack(cropped_faces_t).to(self.device)
+
+            try:
+                output = self.gfpgan(cropped_faces_t, return_rgb=False)[0]
+                restored_faces = [tensor2img(o, rgb2bgr=True, min_max=(-1, 1)) for o in output]
+            except RuntimeError as error:
+                print(f'\tFailed inference for GFPGAN: {error}.')
+                restored_faces = cropped_faces
+            restored_faces = [restored_face.astype('uint8') for restored_face in restored_faces]
+
+        all_restored_faces, restored_imgs, start = [], [], 0
+        for img, faces, affine_matrices in zip(imgs, all_cropped_faces, all_affine_matrices):
+            img_restored_faces = restored_faces[start:start + len(faces)]
+            start += len(faces)
+            all_restored_faces.append(img_restored_faces)
+
+            if not has_aligned and paste_back:
+                self.face_helper.clean_all()
+                self.face_helper.read_image(img)
+                self.face_helper.affine_matrices = affine_matrices
+                for restored_face in img_restored_faces:
+                    self.face_helper.add_restored_face(restored_face)
+                # upsample the background
+                if self.bg_upsampler is not None:
+                    bg_img = self.bg_upsampler.enhance(img, outscale=self.upscale)[0]
+                else:
+                    bg_img = None
+                self.face_helper.get_inverse_affine(None)
+                restored_imgs.append(self.face_helper.paste_faces_to_input_image(upsample_img=bg_img))
+            else:
+                restored_imgs.append(None)
+
+        return all_cropped_faces, all_restored_faces, restored_imgs
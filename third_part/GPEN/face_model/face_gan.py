@@ -39,6 +39,14 @@ class FaceGAN(object):
 
         return out
 
+    def process_batch(self, imgs):
+        img_t = torch.cat([self.img2tensor(cv2.resize(img, (self.resolution, self.resolution))) for img in imgs], 0)
+
+        with torch.no_grad():
+            out, __ = self.model(img_t)
+
+        return [self.tensor2img(o) for o in out]
+
     def img2tensor(self, img):
         img_t = torch.from_numpy(img).to(self.device)/255.
         if self.is_norm:
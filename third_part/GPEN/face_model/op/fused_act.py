@@ -91,6 +91,9 @@ class FusedLeakyReLU(nn.Module):
 
 def fused_leaky_relu(input, bias, negative_slope=0.2, scale=2 ** 0.5, device='cpu'):
     if platform.system() == 'Linux' and torch.cuda.is_available() and device != 'cpu':
-        return FusedLeakyReLUFunction.apply(input, bias, negative_slope, scale)
+        # the kernel supports fp32 and fp16 NCHW inputs, bf16 runs in fp32
+        if input.dtype == torch.bfloat16:
+            input = input.float()
+        return FusedLeakyReLUFunction.apply(input.contiguous(), bias.to(input.dtype), negative_slope, scale)
     else:
         return scale * F.leaky_relu(input + bias.view((1, -1)+(1,)*(len(input.shape)-2)), negative_slope=negative_slope)
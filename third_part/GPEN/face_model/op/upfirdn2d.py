@@ -148,8 +148,11 @@ class UpFirDn2d(Function):
 
 def upfirdn2d(input, kernel, up=1, down=1, pad=(0, 0), device='cpu'):
     if platform.system() == 'Linux' and torch.cuda.is_available() and device != 'cpu':
+        # the kernel supports fp32 and fp16 inputs, bf16 runs in fp32
+        if input.dtype == torch.bfloat16:
+            input = input.float()
         out = UpFirDn2d.apply(
-            input, kernel, (up, up), (down, down), (pad[0], pad[1], pad[0], pad[1])
+            input, kernel.to(input.dtype), (up, up), (down, down), (pad[0], pad[1], pad[0], pad[1])
         )
     else:
         out = upfirdn2d_native(input, kernel, up, up, down, down, pad[0], pad[1], pad[0], pad[1])
@@ -49,39 +49,44 @@ class FaceParse(object):
 
         return mask
 
-    def process_tensor(self, imt):
-        imt = F.interpolate(imt.flip(1)*2-1, (self.size, self.size))
-        pred_mask, sr_img_tensor = self.faceparse(imt)
-
-        mask = pred_mask.argmax(dim=1)
-        for idx, color in enumerate(self.MASK_COLORMAP):
-            mask = torch.where(mask==idx, color, mask)
-        #mask = mask.repeat(3, 1, 1).unsqueeze(0) #.cpu().float().numpy()
-        mask = mask.unsqueeze(0)
+    def process_batch(self, ims, masks=[0, 255, 255, 255, 255, 255, 255, 255, 255, 255, 255, 255, 255, 0, 0, 0, 0, 0, 0], as_tensor=False):
+        # as_tensor: return the masks as a (n, 512, 512) uint8 tensor on the device instead of a list of arrays
+        imt = torch.cat([self.img2tensor(cv2.resize(im, (self.size, self.size))) for im in ims], 0)
+        with torch.no_grad():
+            pred_mask, sr_img_tensor = self.faceparse(imt)  # (n, 19, 512, 512)
+        if as_tensor:
+            return self.labels2mask(pred_mask.argmax(dim=1), masks)
+        mask = self.tenor2mask(pred_mask, masks)
 
         return mask
 
+    def process_tensor(self, imt, masks=None):
+        # imt: (n, 3, h, w) BGR in [0, 1] on the device, returns the (n, 512, 512) uint8 masks on the device
+        imt = F.interpolate(imt.flip(1)*2-1, (self.size, self.size))
+        with torch.no_grad():
+            pred_mask, sr_img_tensor = self.faceparse(imt)
+
+        return self.labels2mask(pred_mask.argmax(dim=1), self.MASK_COLORMAP if masks is None else masks)
+
     def img2tensor(self, img):
         img = img[..., ::-1] # BGR to RGB
         img = img / 255. * 2 - 1
         img_tensor = torch.from_numpy(img.transpose(2, 0, 1)).unsqueeze(0).to(self.device)
         return img_tensor.float()
 
+    def labels2mask(self, labels, masks):
+        # map the class labels to mask values with a single lookup table gather
+        lut = torch.tensor(masks, dtype=torch.uint8, device=labels.device)
+        return lut[labels.long()]
+
     def tenor2mask(self, tensor, masks):
         if len(tensor.shape) < 4:
             tensor = tensor.unsqueeze(0)
         if tensor.shape[1] > 1:
             tensor = tensor.argmax(dim=1) 
 
-        tensor = tensor.squeeze(1).data.cpu().numpy()   # (1, 512, 512)
-        color_maps = []
-        for t in tensor:
-            #tmp_img = np.zeros(tensor.shape[1:] + (3,))
-            tmp_img = np.zeros(tensor.shape[1:])
-            for idx, color in enumerate(masks):
-                tmp_img[t == idx] = color
-            color_maps.append(tmp_img.astype(np.uint8))
-        return color_maps
+        tensor = tensor.squeeze(1).data   # (n, 512, 512)
+        return list(self.labels2mask(tensor, masks).cpu().numpy())
 
 
 
@@ -1,5 +1,8 @@
 import cv2
 import numpy as np
+import torch
+import torch.nn.functional as F
+from kornia.geometry import warp_affine
 
 ######### face enhancement
 from face_parse.face_parsing import FaceParse
@@ -8,11 +11,12 @@ from face_parse.face_parsing import FaceParse
 from face_model.face_gan import FaceGAN
 # from sr_model.real_esrnet import RealESRNet
 from align_faces import warp_and_crop_face, get_reference_facial_points
-from utils.inference_utils import Laplacian_Pyramid_Blending_with_mask
+from utils.inference_utils import blend_frames
 
 class FaceEnhancement(object):
-    def __init__(self, base_dir='./', size=512, model=None, use_sr=True, sr_model=None, channel_multiplier=2, narrow=1, device='cuda'):
-        self.facedetector = RetinaFaceDetection(base_dir, device)
+    def __init__(self, base_dir='./', size=512, model=None, use_sr=True, sr_model=None, channel_multiplier=2, narrow=1, device='cuda', facedetector=None):
+        self.device = device
+        self.facedetector = facedetector if facedetector is not None else RetinaFaceDetection(base_dir, device)
         self.facegan = FaceGAN(base_dir, size, model, channel_multiplier, narrow, device=device)
         # self.srmodel =  RealESRNet(base_dir, sr_model, device=device)
         self.srmodel=None
@@ -39,6 +43,11 @@ class FaceEnhancement(object):
         self.reference_5pts = get_reference_facial_points(
                 (self.size, self.size), inner_padding_factor, outer_padding, default_square)
 
+        # separable kernels of the mask blurs and the small face filter for process_batch
+        self.mask_kernel = torch.from_numpy(np.float32(cv2.getGaussianKernel(101, 11))[:, 0]).to(device)
+        self.sharp_kernel = torch.from_numpy(np.float32(cv2.getGaussianKernel(9, 1))[:, 0]).to(device)
+        self.small_face_kernel = torch.from_numpy(self.kernel).to(device)[None, None]
+
     def mask_postprocess(self, mask, thres=20):
         mask[:thres, :] = 0; mask[-thres:, :] = 0
         mask[:, :thres] = 0; mask[:, -thres:] = 0        
@@ -46,13 +55,22 @@ class FaceEnhancement(object):
         mask = cv2.GaussianBlur(mask, (101, 101), 11)
         return mask.astype(np.float32)
     
-    def process(self, img, ori_img, bbox=None, face_enhance=True, possion_blending=False):
+    def detect_faces(self, img, bbox=None, landmarks_5=None):
+        if landmarks_5 is not None and bbox is not None:
+            # aligned: the face box (y1, y2, x1, x2) and its (5, 2) landmarks are known, skip the detection
+            y1, y2, x1, x2 = bbox
+            facebs = np.array([[x1, y1, x2, y2, 1.]])
+            landms = np.asarray(landmarks_5, dtype=np.float32).T.reshape(1, 10)
+            return facebs, landms
+        return self.facedetector.detect(img.copy())
+
+    def process(self, img, ori_img, bbox=None, face_enhance=True, possion_blending=False, landmarks_5=None):
         if self.use_sr:
             img_sr = self.srmodel.process(img)
             if img_sr is not None:
                 img = cv2.resize(img, img_sr.shape[:2][::-1])
 
-        facebs, landms = self.facedetector.detect(img.copy())
+        facebs, landms = self.detect_faces(img, bbox, landmarks_5)
 
         orig_faces, enhanced_faces = [], []
         height, width = img.shape[:2]
@@ -123,16 +141,93 @@ class FaceEnhancement(object):
                 y1, y2, x1, x2 = bbox
                 mask_bbox = np.zeros_like(mask_sharp)
                 mask_bbox[y1:y2 - 5, x1:x2] = 1
-                full_img, ori_img, full_mask = [cv2.resize(x,(512,512)) for x in (full_img, ori_img, np.float32(mask_sharp * mask_bbox))]
-            else:
-                full_img, ori_img, full_mask = [cv2.resize(x,(512,512)) for x in (full_img, ori_img, full_mask)]
-            
-            img = Laplacian_Pyramid_Blending_with_mask(full_img, ori_img, full_mask, 6)
-            img = np.clip(img, 0 ,255)
-            img = np.uint8(cv2.resize(img, (width, height)))
+                full_mask = np.float32(mask_sharp * mask_bbox)
+
+            img = blend_frames([full_img], [ori_img], [full_mask], 6, size=(512, 512), device=self.device)[0]
 
         else:
             img = cv2.convertScaleAbs(ori_img*(1-full_mask) + full_img*full_mask)
             img = cv2.convertScaleAbs(ori_img*(1-mask_sharp) + img*mask_sharp)
 
-        return img, orig_faces, enhanced_faces
\ No newline at end of file
+        return img, orig_faces, enhanced_faces
+
+    def process_batch(self, imgs, ori_imgs, bboxes=None, face_enhance=True, landmarks_5=None):
+        """Batched ``process`` for frames of the same size, without super resolution and poisson blending.
+
+        The faces of all the frames go through GPEN and the face parser at once, the mask blurs, the
+        inverse warps and the blending run on the device. Returns lists with one entry per frame.
+        """
+        n = len(imgs)
+        bboxes = [None] * n if bboxes is None else bboxes
+        landmarks_5 = [None] * n if landmarks_5 is None else landmarks_5
+        height, width = imgs[0].shape[:2]
+
+        face_ids, ofs, tfm_invs, small = [], [], [], []
+        for i, (img, bbox, lm5) in enumerate(zip(imgs, bboxes, landmarks_5)):
+            facebs, landms = self.detect_faces(img, bbox, lm5)
+            for faceb, facial5points in zip(facebs, landms):
+                if faceb[4]<self.threshold: continue
+                fh, fw = (faceb[3]-faceb[1]), (faceb[2]-faceb[0])
+                of, tfm_inv = warp_and_crop_face(img, np.reshape(facial5points, (2, 5)), reference_pts=self.reference_5pts, crop_size=(self.size, self.size))
+                face_ids.append(i)
+                ofs.append(of)
+                tfm_invs.append(tfm_inv)
+                small.append(min(fh, fw)<100)
+        if len(ofs) == 0:
+            return [ori_img.copy() for ori_img in ori_imgs], [[] for _ in range(n)], [[] for _ in range(n)]
+
+        efs = self.facegan.process_batch(ofs) if face_enhance else ofs
+        orig_faces = [[of for of, j in zip(ofs, face_ids) if j == i] for i in range(n)]
+        enhanced_faces = [[ef for ef, j in zip(efs, face_ids) if j == i] for i in range(n)]
+
+        # no ear, no neck, no hair&hat,  only face region, see process
+        mm = [0, 255, 255, 255, 255, 255, 255, 255, 0, 0, 255, 255, 255, 0, 0, 0, 0, 0, 0]
+        mask_sharp = self.faceparser.process_batch(efs, mm, as_tensor=True)[:, None].float() / 255.
+        thres = 20  # mask_postprocess, which also zeroes the borders of mask_sharp
+        mask_sharp[..., :thres, :] = 0; mask_sharp[..., -thres:, :] = 0
+        mask_sharp[..., :, :thres] = 0; mask_sharp[..., :, -thres:] = 0
+        tmp_mask = separable_blur(separable_blur(mask_sharp, self.mask_kernel), self.mask_kernel)
+
+        faces = torch.from_numpy(np.stack(efs)).to(self.device).permute(0, 3, 1, 2).float()
+        if face_enhance and any(small): # gaussian filter for small faces
+            small = torch.tensor(small, device=self.device)
+            faces[small] = filter2d(faces[small], self.small_face_kernel).round_().clamp_(0, 255)
+
+        # inverse warps of the faces and both masks in a single pass
+        tfm_invs = torch.from_numpy(np.float32(np.stack(tfm_invs))).to(self.device)
+        warped = warp_affine(torch.cat([faces, tmp_mask, mask_sharp], 1), tfm_invs, dsize=(height, width), align_corners=True)
+        tmp_imgs, tmp_masks, sharp_masks = warped[:, :3].round_(), warped[:, 3:4], warped[:, 4:5]
+
+        full_mask = torch.zeros(n, 1, height, width, device=self.device)
+        full_img = torch.zeros(n, 3, height, width, device=self.device)
+        mask_sharp = torch.zeros(n, 1, height, width, device=self.device)
+        for k, i in enumerate(face_ids):
+            update = tmp_masks[k] > full_mask[i]
+            full_mask[i] = torch.where(update, tmp_masks[k], full_mask[i])
+            full_img[i] = torch.where(update, tmp_imgs[k], full_img[i])
+            mask_sharp[i] = sharp_masks[k] # the last face of the frame, as in process
+        mask_sharp = separable_blur(mask_sharp, self.sharp_kernel)
+
+        ori_t = torch.from_numpy(np.stack(ori_imgs)).to(self.device).permute(0, 3, 1, 2).float()
+        img = (ori_t*(1-full_mask) + full_img*full_mask).round_().clamp_(0, 255)
+        img = (ori_t*(1-mask_sharp) + img*mask_sharp).round_().clamp_(0, 255)
+        imgs = list(img.permute(0, 2, 3, 1).to(torch.uint8).cpu().numpy())
+        return imgs, orig_faces, enhanced_faces
+
+
+def separable_blur(x, kernel):
+    # (n, c, h, w) gaussian blur with a 1d kernel and the reflect-101 border of cv2.GaussianBlur
+    n, c, h, w = x.shape
+    k = kernel.numel()
+    x = x.reshape(n * c, 1, h, w)
+    x = F.conv2d(F.pad(x, (k // 2, k // 2, 0, 0), mode='reflect'), kernel.view(1, 1, 1, k))
+    x = F.conv2d(F.pad(x, (0, 0, k // 2, k // 2), mode='reflect'), kernel.view(1, 1, k, 1))
+    return x.reshape(n, c, h, w)
+
+
+def filter2d(x, kernel):
+    # cv2.filter2D of every channel with a (1, 1, k, k) kernel
+    n, c, h, w = x.shape
+    p = kernel.shape[-1] // 2
+    x = F.conv2d(F.pad(x.reshape(n * c, 1, h, w), (p, p, p, p), mode='reflect'), kernel)
+    return x.reshape(n, c, h, w)
@@ -4,6 +4,7 @@ import time
 import glob
 import argparse
 import face_alignment
+from face_alignment.utils import crop, get_preds_fromhm
 import numpy as np
 from PIL import Image
 import torch
@@ -13,11 +14,14 @@ from itertools import cycle
 from torch.multiprocessing import Pool, Process, set_start_method
 
 class KeypointExtractor():
+    # frames whose tracked landmarks score lower than this are detected again
+    track_score_threshold = 0.5
+
     def __init__(self):
         device = 'cuda' if torch.cuda.is_available() else 'cpu'
         self.detector = face_alignment.FaceAlignment(face_alignment.LandmarksType._2D, device=device)   
 
-    def extract_keypoint(self, images, name=None, info=True):
+    def extract_keypoint(self, images, name=None, info=True, track_interval=0):
         if isinstance(images, list):
             keypoints = []
             if info:
@@ -25,37 +29,152 @@ class KeypointExtractor():
             else:
                 i_range = images
 
-            for image in i_range:
-                current_kp = self.extract_keypoint(image)
+            # with track_interval > 1 the face is only detected every track_interval frames, the frames in
+            # between reuse the previous face box as the FAN region unless the landmark score drops
+            box = None
+            for idx, image in enumerate(i_range):
+                tracked = track_interval > 1 and box is not None and idx % track_interval != 0
+                if tracked:
+                    current_kp, _, score = self.detect(image, detected_faces=[box])
+                    tracked = score >= self.track_score_threshold
+                if not tracked:
+                    current_kp, box, _ = self.detect(image)
                 if np.mean(current_kp) == -1 and keypoints:
                     keypoints.append(keypoints[-1])
                 else:
                     keypoints.append(current_kp[None])
 
             keypoints = np.concatenate(keypoints, 0)
-            np.savetxt(os.path.splitext(name)[0]+'.txt', keypoints.reshape(-1))
+            if name is not None:
+                np.savetxt(os.path.splitext(name)[0]+'.txt', keypoints.reshape(-1))
             return keypoints
         else:
-            while True:
-                try:
-                    keypoints = self.detector.get_landmarks_from_image(np.array(images))[0]
-                    break
-                except RuntimeError as e:
-                    if str(e).startswith('CUDA'):
-                        print("Warning: out of memory, sleep for 1s")
-                        time.sleep(1)
-                    else:
-                        print(e)
-                        break    
-                except TypeError:
-                    print('No face detected in this image')
-                    shape = [68, 2]
-                    keypoints = -1. * np.ones(shape)                    
-                    break
+            keypoints = self.detect(images)[0]
             if name is not None:
                 np.savetxt(os.path.splitext(name)[0]+'.txt', keypoints.reshape(-1))
             return keypoints
 
+    def extract_keypoint_batch(self, images, name=None, info=True, batch_size=16, track_interval=0):
+        """Batched ``extract_keypoint`` for frames of the same size.
+
+        Faces are detected per batch and FAN runs once on the stacked face crops. On CUDA OOM the batch size
+        is halved. The landmarks are returned (and saved if ``name`` is given) as a float32 array.
+        """
+        keypoints, box, start = [], None, 0
+        pbar = tqdm(total=len(images), desc='landmark Det:') if info else None
+        while start < len(images):
+            batch = images[start:start + batch_size]
+            try:
+                batch_kps, box = self._keypoint_batch(batch, start, box, track_interval)
+            except RuntimeError as e:
+                if not str(e).startswith('CUDA') or batch_size == 1:
+                    raise
+                batch_size //= 2
+                print('Recovering from OOM error; New batch size: {}'.format(batch_size))
+                torch.cuda.empty_cache()
+                continue
+
+            for current_kp in batch_kps:
+                if np.mean(current_kp) == -1 and keypoints:
+                    keypoints.append(keypoints[-1])
+                else:
+                    keypoints.append(current_kp[None])
+            start += len(batch)
+            if pbar is not None:
+                pbar.update(len(batch))
+        if pbar is not None:
+            pbar.close()
+
+        keypoints = np.concatenate(keypoints, 0).astype(np.float32)
+        if name is not None:
+            np.save(os.path.splitext(name)[0]+'.npy', keypoints)
+        return keypoints
+
+    def _keypoint_batch(self, batch, start, box, track_interval):
+        frames = np.stack([np.array(image) for image in batch])
+        frames_t = torch.from_numpy(frames).permute(0, 3, 1, 2).float().to(self.detector.device)
+
+        # detect on every frame, or only on keyframes when tracking (see extract_keypoint)
+        if track_interval > 1:
+            keys = [i for i in range(len(batch)) if (start + i) % track_interval == 0 or (i == 0 and box is None)]
+        else:
+            keys = list(range(len(batch)))
+        boxes = self._detect_faces(frames_t, keys)
+        for i in range(len(batch)):
+            if i in keys:
+                box = boxes[i]
+            else:
+                boxes[i] = box
+        landmarks, scores = self._fan(frames, boxes)
+
+        if track_interval > 1:
+            retry = [i for i in range(len(batch)) if i not in keys and scores[i] < self.track_score_threshold]
+            if len(retry) > 0:
+                retry_boxes = self._detect_faces(frames_t, retry)
+                retry_landmarks, _ = self._fan(frames[retry], [retry_boxes[i] for i in retry])
+                for k, i in enumerate(retry):
+                    boxes[i], landmarks[i] = retry_boxes[i], retry_landmarks[k]
+                box = boxes[-1]
+        return landmarks, box
+
+    def _detect_faces(self, frames_t, ids):
+        # the first detected face of the frames ids, None where there is no face
+        boxes = {}
+        if len(ids) > 0:
+            with torch.no_grad():
+                detections = self.detector.face_detector.detect_from_batch(frames_t[ids])
+            for i, d in zip(ids, detections):
+                boxes[i] = d[0] if len(d) > 0 else None
+        return [boxes.get(i) for i in range(len(frames_t))]
+
+    def _fan(self, frames, boxes):
+        # FAN on the face crops of all the frames with a box at once, same cropping as get_landmarks_from_image
+        landmarks, scores = -1. * np.ones([len(frames), 68, 2]), np.zeros(len(frames))
+        ids = [i for i, d in enumerate(boxes) if d is not None]
+        if len(ids) == 0:
+            return landmarks, scores
+        centers, scales, inps = [], [], []
+        for i in ids:
+            d = boxes[i]
+            center = np.array([d[2] - (d[2] - d[0]) / 2.0, d[3] - (d[3] - d[1]) / 2.0])
+            center[1] = center[1] - (d[3] - d[1]) * 0.12
+            scale = (d[2] - d[0] + d[3] - d[1]) / self.detector.face_detector.reference_scale
+            centers.append(center)
+            scales.append(scale)
+            inps.append(crop(frames[i], center, scale))
+        inp = torch.from_numpy(np.stack(inps).transpose(0, 3, 1, 2)).float().to(self.detector.device).div_(255.0)
+        with torch.no_grad():
+            out = self.detector.face_alignment_net(inp).to(device='cpu', dtype=torch.float32).numpy()
+        for k, i in enumerate(ids):
+            # face-alignment 1.3.4 returns (preds, preds_orig), the score is the mean of the heatmap maxima
+            _, pts_img = get_preds_fromhm(out[k:k + 1], centers[k], scales[k])
+            landmarks[i] = pts_img.reshape(68, 2)
+            scores[i] = np.mean(out[k].reshape(68, -1).max(1))
+        return landmarks, scores
+
+    def detect(self, image, detected_faces=None):
+        # landmarks, face box and mean landmark score of the first face; -1 landmarks if there is none.
+        # same detection and cropping as get_landmarks_from_image of face-alignment 1.3.4, FAN runs through
+        # _fan for the heatmap score
+        image = np.array(image)
+        while True:
+            try:
+                if detected_faces is None:
+                    detected_faces = self.detector.face_detector.detect_from_image(image.copy())
+                if detected_faces is None or len(detected_faces) == 0:
+                    print('No face detected in this image')
+                    break
+                landmarks, scores = self._fan(image[None], [detected_faces[0]])
+                return landmarks[0], detected_faces[0], scores[0]
+            except RuntimeError as e:
+                if str(e).startswith('CUDA'):
+                    print("Warning: out of memory, sleep for 1s")
+                    time.sleep(1)
+                else:
+                    print(e)
+                    break
+        return -1. * np.ones([68, 2]), None, 0.
+
 def read_video(filename):
     frames = []
     cap = cv2.VideoCapture(filename)
@@ -64,6 +64,36 @@ def nms(dets, thresh):
     return keep
 
 
+def nms_torch(dets, thresh, image_ids=None):
+    """Same greedy suppression as ``nms`` on a (n, 5) tensor, on the device of ``dets``.
+
+    With ``image_ids`` the boxes of a whole batch are suppressed in one pass, boxes of different
+    images are shifted apart so they never overlap. Returns the kept indices by decreasing score.
+    """
+    if 0 == len(dets):
+        return torch.zeros(0, dtype=torch.long, device=dets.device)
+    boxes, scores = dets[:, :4], dets[:, 4]
+    if image_ids is not None:
+        boxes = boxes + (image_ids.to(boxes) * (boxes.max() - boxes.min() + 2))[:, None]
+    order = scores.argsort(descending=True)
+    x1, y1, x2, y2 = boxes[order].unbind(1)
+    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+
+    xx1, yy1 = torch.max(x1[:, None], x1[None]), torch.max(y1[:, None], y1[None])
+    xx2, yy2 = torch.min(x2[:, None], x2[None]), torch.min(y2[:, None], y2[None])
+    w, h = (xx2 - xx1 + 1).clamp(min=0), (yy2 - yy1 + 1).clamp(min=0)
+    ovr = w * h / (areas[:, None] + areas[None] - w * h)
+    overlap = (ovr > thresh).cpu().numpy()
+
+    # one iteration per kept box, every box overlaps itself
+    keep, remaining = [], np.ones(len(order), dtype=bool)
+    while remaining.any():
+        i = np.argmax(remaining)
+        keep.append(i)
+        remaining &= ~overlap[i]
+    return order[torch.as_tensor(keep, device=order.device)]
+
+
 def encode(matched, priors, variances):
     """Encode the variances from the priorbox layers into the ground truth boxes
     we have matched (based on jaccard overlap) with the prior boxes.
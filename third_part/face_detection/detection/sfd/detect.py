@@ -17,45 +17,19 @@ from .bbox import *
 
 
 def detect(net, img, device):
-    img = img - np.array([104, 117, 123])
-    img = img.transpose(2, 0, 1)
-    img = img.reshape((1,) + img.shape)
-
-    if 'cuda' in device:
-        torch.backends.cudnn.benchmark = True
-
-    img = torch.from_numpy(img).float().to(device)
-    BB, CC, HH, WW = img.size()
-    with torch.no_grad():
-        olist = net(img)
-
-    bboxlist = []
-    for i in range(len(olist) // 2):
-        olist[i * 2] = F.softmax(olist[i * 2], dim=1)
-    olist = [oelem.data.cpu() for oelem in olist]
-    for i in range(len(olist) // 2):
-        ocls, oreg = olist[i * 2], olist[i * 2 + 1]
-        FB, FC, FH, FW = ocls.size()  # feature map size
-        stride = 2**(i + 2)    # 4,8,16,32,64,128
-        anchor = stride * 4
-        poss = zip(*np.where(ocls[:, 1, :, :] > 0.05))
-        for Iindex, hindex, windex in poss:
-            axc, ayc = stride / 2 + windex * stride, stride / 2 + hindex * stride
-            score = ocls[0, 1, hindex, windex]
-            loc = oreg[0, :, hindex, windex].contiguous().view(1, 4)
-            priors = torch.Tensor([[axc / 1.0, ayc / 1.0, stride * 4 / 1.0, stride * 4 / 1.0]])
-            variances = [0.1, 0.2]
-            box = decode(loc, priors, variances)
-            x1, y1, x2, y2 = box[0] * 1.0
-            # cv2.rectangle(imgshow,(int(x1),int(y1)),(int(x2),int(y2)),(0,0,255),1)
-            bboxlist.append([x1, y1, x2, y2, score])
-    bboxlist = np.array(bboxlist)
+    dets, _ = batch_detect(net, img[None], device)
+    bboxlist = dets.cpu().numpy()
     if 0 == len(bboxlist):
         bboxlist = np.zeros((1, 5))
 
     return bboxlist
 
-def batch_detect(net, imgs, device):
+def batch_detect(net, imgs, device, threshold=0.05):
+    """Runs S3FD on a batch and decodes every anchor above ``threshold`` at once.
+
+    Returns the (n, 5) boxes (x1, y1, x2, y2, score) of the whole batch and the index of the
+    image each box belongs to, both on ``device``.
+    """
     imgs = imgs - np.array([104, 117, 123])
     imgs = imgs.transpose(0, 3, 1, 2)
 
@@ -65,36 +39,21 @@ def batch_detect(net, imgs, device):
     imgs = torch.from_numpy(imgs).float().to(device)
     BB, CC, HH, WW = imgs.size()
     with torch.no_grad():
-        # print(type(net),type(imgs), device)
         olist = net(imgs)
 
-    bboxlist = []
-    for i in range(len(olist) // 2):
-        olist[i * 2] = F.softmax(olist[i * 2], dim=1)
-    # print(olist)
-    # import pdb; pdb.set_trace()
-    olist = [oelem.cpu() for oelem in olist]
-    for i in range(len(olist) // 2):
-        ocls, oreg = olist[i * 2], olist[i * 2 + 1]
-        FB, FC, FH, FW = ocls.size()  # feature map size
-        stride = 2**(i + 2)    # 4,8,16,32,64,128
-        anchor = stride * 4
-        poss = zip(*np.where(ocls[:, 1, :, :] > 0.05))
-        for Iindex, hindex, windex in poss:
-            axc, ayc = stride / 2 + windex * stride, stride / 2 + hindex * stride
-            score = ocls[:, 1, hindex, windex]
-            loc = oreg[:, :, hindex, windex].contiguous().view(BB, 1, 4)
-            priors = torch.Tensor([[axc / 1.0, ayc / 1.0, stride * 4 / 1.0, stride * 4 / 1.0]]).view(1, 1, 4)
-            variances = [0.1, 0.2]
-            box = batch_decode(loc, priors, variances)
-            box = box[:, 0] * 1.0
-            # cv2.rectangle(imgshow,(int(x1),int(y1)),(int(x2),int(y2)),(0,0,255),1)
-            bboxlist.append(torch.cat([box, score.unsqueeze(1)], 1).cpu().numpy())
-    bboxlist = np.array(bboxlist)
-    if 0 == len(bboxlist):
-        bboxlist = np.zeros((1, BB, 5))
-
-    return bboxlist
+        dets, image_ids = [], []
+        variances = [0.1, 0.2]
+        for i in range(len(olist) // 2):
+            ocls, oreg = F.softmax(olist[i * 2], dim=1), olist[i * 2 + 1]
+            stride = 2**(i + 2)    # 4,8,16,32,64,128
+            b_idx, h_idx, w_idx = torch.nonzero(ocls[:, 1, :, :] > threshold, as_tuple=True)
+            anchor = torch.full_like(h_idx, stride * 4, dtype=torch.float32)
+            priors = torch.stack([stride / 2 + w_idx.float() * stride, stride / 2 + h_idx.float() * stride, anchor, anchor], 1)
+            box = decode(oreg[b_idx, :, h_idx, w_idx], priors, variances)
+            dets.append(torch.cat([box, ocls[b_idx, 1, h_idx, w_idx].unsqueeze(1)], 1))
+            image_ids.append(b_idx)
+
+    return torch.cat(dets, 0), torch.cat(image_ids, 0)
 
 def flip_detect(net, img, device):
     img = cv2.flip(img, 1)
@@ -14,9 +14,14 @@ models_urls = {
 
 
 class SFDDetector(FaceDetector):
-    def __init__(self, device, path_to_detector='/apdcephfs/share_1290939/shadowcun/pretrained/s3fd.pth', verbose=False):
+    def __init__(self, device, path_to_detector='/apdcephfs/share_1290939/shadowcun/pretrained/s3fd.pth', verbose=False, net=None):
         super(SFDDetector, self).__init__(device, verbose)
 
+        # an already loaded s3fd network can be shared instead of loading the weights again
+        if net is not None:
+            self.face_detector = net
+            return
+
         # Initialise the face detector
         if not os.path.isfile(path_to_detector):
             model_weights = load_url(models_urls['s3fd'])
@@ -39,10 +44,14 @@ class SFDDetector(FaceDetector):
         return bboxlist
 
     def detect_from_batch(self, images):
-        bboxlists = batch_detect(self.face_detector, images, device=self.device)
-        keeps = [nms(bboxlists[:, i, :], 0.3) for i in range(bboxlists.shape[1])]
-        bboxlists = [bboxlists[keep, i, :] for i, keep in enumerate(keeps)]
-        bboxlists = [[x for x in bboxlist if x[-1] > 0.5] for bboxlist in bboxlists]
+        dets, image_ids = batch_detect(self.face_detector, images, device=self.device)
+        # boxes under 0.5 are dropped after the nms and can only suppress boxes with even lower scores,
+        # so dropping them first gives the same result with a much smaller overlap matrix
+        confident = dets[:, 4] > 0.5
+        dets, image_ids = dets[confident], image_ids[confident]
+        keep = nms_torch(dets, 0.3, image_ids)
+        dets, image_ids = dets[keep].cpu().numpy(), image_ids[keep].cpu().numpy()
+        bboxlists = [list(dets[image_ids == i]) for i in range(len(images))]
 
         return bboxlists
 
@@ -1,6 +1,8 @@
 import librosa
 import librosa.filters
 import numpy as np
+import subprocess
+import torch
 # import tensorflow as tf
 from scipy import signal
 from scipy.io import wavfile
@@ -9,6 +11,12 @@ from .hparams import hparams as hp
 def load_wav(path, sr):
     return librosa.core.load(path, sr=sr)[0]
 
+def load_wav_ffmpeg(path, sr):
+    # decode any container straight to mono float32 at sr through a pipe, no temp file
+    command = ['ffmpeg', '-loglevel', 'error', '-i', path, '-vn', '-ac', '1', '-ar', str(sr), '-f', 'f32le', '-']
+    out = subprocess.run(command, stdout=subprocess.PIPE, check=True).stdout
+    return np.frombuffer(out, dtype=np.float32)
+
 def save_wav(wav, path, sr):
     wav *= 32767 / max(0.01, np.max(np.abs(wav)))
     #proposed by @dsmiller
@@ -42,14 +50,47 @@ def linearspectrogram(wav):
         return _normalize(S)
     return S
 
-def melspectrogram(wav):
-    D = _stft(preemphasis(wav, hp.preemphasis, hp.preemphasize))
-    S = _amp_to_db(_linear_to_mel(np.abs(D))) - hp.ref_level_db
+def melspectrogram(wav, device=None):
+    # with a device the STFT and mel projection run with torch on it
+    if device is not None:
+        S = _amp_to_db(_mel_torch(preemphasis(wav, hp.preemphasis, hp.preemphasize), device)) - hp.ref_level_db
+    else:
+        D = _stft(preemphasis(wav, hp.preemphasis, hp.preemphasize))
+        S = _amp_to_db(_linear_to_mel(np.abs(D))) - hp.ref_level_db
     
     if hp.signal_normalization:
         return _normalize(S)
     return S
 
+def mel_chunk_starts(num_mel_frames, fps, mel_step_size=16):
+    """Start index of the mel window of every video frame, the window of the last frame is clamped to the end of the clip."""
+    mel_idx_multiplier = 80. / fps
+    last_start = num_mel_frames - mel_step_size
+    starts = (np.arange(int((last_start + 1) / mel_idx_multiplier) + 2) * mel_idx_multiplier).astype(np.int64)
+    return np.append(starts[starts <= last_start], last_start)
+
+class MelChunks:
+    """The mel_step_size windows of a mel spectrogram for a video at fps, one per video frame.
+
+    All windows share one strided view of the spectrogram, indexing a frame (or a range of frames)
+    returns views, nothing is copied.
+    """
+    def __init__(self, mel, fps, mel_step_size=16):
+        self.windows = np.lib.stride_tricks.sliding_window_view(mel, mel_step_size, axis=1) # (num_mels, T - step + 1, step)
+        self.starts = mel_chunk_starts(mel.shape[1], fps, mel_step_size)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.windows[:, start] for start in self.starts[index]]
+        return self.windows[:, self.starts[index]]
+
+    def __iter__(self):
+        for start in self.starts:
+            yield self.windows[:, start]
+
 def _lws_processor():
     import lws
     return lws.lws(hp.n_fft, get_hop_size(), fftsize=hp.win_size, mode="speech")
@@ -58,7 +99,32 @@ def _stft(y):
     if hp.use_lws:
         return _lws_processor(hp).stft(y).T
     else:
-        return librosa.stft(y=y, n_fft=hp.n_fft, hop_length=get_hop_size(), win_length=hp.win_size)
+        return librosa.stft(y=y, n_fft=hp.n_fft, hop_length=get_hop_size(), win_length=hp.win_size, window=_get_window())
+
+_window = None
+
+def _get_window():
+    global _window
+    if _window is None:
+        _window = librosa.filters.get_window('hann', hp.win_size, fftbins=True)
+    return _window
+
+_torch_buffers = {}
+
+def _mel_torch(y, device):
+    # same as _linear_to_mel(np.abs(_stft(y))) with the window and mel basis cached on the device,
+    # librosa 0.9 zero-pads the signal (pad_mode='constant'), the edge frames depend on it
+    device = torch.device(device)
+    if device not in _torch_buffers:
+        _torch_buffers[device] = (torch.hann_window(hp.win_size, periodic=True, device=device),
+                                  torch.from_numpy(_build_mel_basis()).float().to(device))
+    window, mel_basis = _torch_buffers[device]
+    y = torch.from_numpy(np.ascontiguousarray(y, dtype=np.float32)).to(device)
+    with torch.no_grad():
+        D = torch.stft(y, n_fft=hp.n_fft, hop_length=get_hop_size(), win_length=hp.win_size, window=window,
+                       center=True, pad_mode='constant', return_complex=True)
+        S = torch.matmul(mel_basis, D.abs())
+    return S.cpu().numpy()
 
 ##########################################################
 #Those are only correct when using lws!!! (This was messing with Wavenet quality for a long time!)
@@ -115,7 +115,7 @@ class Croper:
         # Save aligned image.
         return crop, [lx, ly, rx, ry]
     
-    def crop(self, img_np_list, xsize=512):    # first frame for all video
+    def get_crop(self, img_np_list, xsize=512):    # first frame for all video
         idx = 0
         while idx < len(img_np_list)//2 :   # TODO 
             img_np = img_np_list[idx]
@@ -127,6 +127,9 @@ class Croper:
             return None
         
         crop, quad = self.align_face(img=Image.fromarray(img_np), lm=lm, output_size=xsize)
+        return crop, quad
+
+    def apply_crop(self, img_np_list, crop, quad):
         clx, cly, crx, cry = crop
         lx, ly, rx, ry = quad
         lx, ly, rx, ry = int(lx), int(ly), int(rx), int(ry)
@@ -135,6 +138,13 @@ class Croper:
             _inp = _inp[cly:cry, clx:crx]
             _inp = _inp[ly:ry, lx:rx]
             img_np_list[_i] = _inp
-        return img_np_list, crop, quad
+        return img_np_list
+
+    def crop(self, img_np_list, xsize=512):    # first frame for all video
+        crop_quad = self.get_crop(img_np_list, xsize)
+        if crop_quad is None:
+            return None
+        crop, quad = crop_quad
+        return self.apply_crop(img_np_list, crop, quad), crop, quad
 
 
@@ -0,0 +1,54 @@
+import os
+import subprocess
+
+
+class FFmpegWriter:
+    """Drop-in for cv2.VideoWriter that pipes raw BGR frames to ffmpeg and muxes the audio in the same pass.
+
+    The frames are encoded once with ``vcodec``/``preset``/``crf`` and no intermediate video file is written.
+    Used as a context manager, ffmpeg is killed and the partial output removed if the block raises.
+    """
+
+    def __init__(self, outfile, fps, frame_size, audio=None, vcodec='libx264', preset='medium', crf=18, acodec='aac'):
+        width, height = frame_size
+        out_dir = os.path.dirname(outfile)
+        if out_dir:
+            os.makedirs(out_dir, exist_ok=True)
+
+        command = ['ffmpeg', '-loglevel', 'error', '-y',
+                   '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', '{}x{}'.format(width, height), '-r', str(fps), '-i', '-']
+        if audio is not None:
+            command += ['-i', audio, '-map', '0:v:0', '-map', '1:a:0', '-c:a', acodec]
+        # yuv420p needs even dimensions
+        command += ['-c:v', vcodec, '-preset', preset, '-crf', str(crf),
+                    '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-pix_fmt', 'yuv420p', outfile]
+        self.outfile = outfile
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+
+    def write(self, frame):
+        self.process.stdin.write(frame.tobytes())
+
+    def release(self):
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            raise RuntimeError('ffmpeg failed to encode {}'.format(self.outfile))
+
+    def abort(self):
+        # stop ffmpeg and remove the truncated output
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        self.process.kill()
+        self.process.wait()
+        if os.path.exists(self.outfile):
+            os.remove(self.outfile)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.release()
+        else:
+            self.abort()
@@ -0,0 +1,114 @@
+import cv2
+import numpy as np
+
+
+IMAGE_EXTENSIONS = ['jpg', 'png', 'jpeg']
+
+
+def crop_frame(frame, crop):
+    y1, y2, x1, x2 = crop
+    if x2 == -1: x2 = frame.shape[1]
+    if y2 == -1: y2 = frame.shape[0]
+    return frame[y1:y2, x1:x2]
+
+
+class FrameStream:
+    """Lazily decodes the frames of a video (or a single image) in bounded chunks.
+
+    Only ``chunk_size`` BGR frames are resident at a time, so consumers that
+    process the clip chunk by chunk have a peak memory that depends on the
+    chunk size rather than on the length of the clip.
+    """
+
+    def __init__(self, path, crop=(0, -1, 0, -1), chunk_size=64, fps=25., info=None):
+        self.path = path
+        self.crop = crop
+        self.chunk_size = chunk_size
+        # utils.media_info.probe result, gives the fps without opening the video and sizes read_all's buffer
+        self.info = info
+        self.is_image = path.split('.')[-1].lower() in IMAGE_EXTENSIONS
+        if self.is_image:
+            self.fps = fps
+            self._num_frames = 1
+        elif info is not None and info.fps:
+            self.fps = info.fps
+            self._num_frames = None
+        else:
+            video_stream = cv2.VideoCapture(path)
+            self.fps = video_stream.get(cv2.CAP_PROP_FPS)
+            self._num_frames = None
+            video_stream.release()
+
+    def __len__(self):
+        # CAP_PROP_FRAME_COUNT is only an estimate for many containers, count by decoding once.
+        if self._num_frames is None:
+            video_stream = cv2.VideoCapture(self.path)
+            num_frames = 0
+            while video_stream.grab():
+                num_frames += 1
+            video_stream.release()
+            self._num_frames = num_frames
+        return self._num_frames
+
+    def __iter__(self):
+        if self.is_image:
+            yield cv2.imread(self.path)
+            return
+        video_stream = cv2.VideoCapture(self.path)
+        num_frames = 0
+        try:
+            while True:
+                still_reading, frame = video_stream.read()
+                if not still_reading:
+                    break
+                num_frames += 1
+                yield crop_frame(frame, self.crop)
+            self._num_frames = num_frames
+        finally:
+            video_stream.release()
+
+    def chunks(self, num_frames=None, loop=False):
+        """Yields ``(start_index, frames)`` with at most ``chunk_size`` frames per chunk.
+
+        With ``loop=True`` the clip is decoded again from the beginning whenever it
+        runs out, until ``num_frames`` frames were produced (``start_index`` keeps
+        counting in output order).
+        """
+        produced, chunk = 0, []
+        while num_frames is None or produced + len(chunk) < num_frames:
+            empty, frames = True, iter(self)
+            for frame in frames:
+                empty = False
+                chunk.append(frame)
+                if num_frames is not None and produced + len(chunk) == num_frames:
+                    frames.close()
+                    break
+                if len(chunk) == self.chunk_size:
+                    yield produced, chunk
+                    produced, chunk = produced + len(chunk), []
+            if not loop or empty:
+                break
+        if len(chunk) > 0:
+            yield produced, chunk
+
+    def read_all(self):
+        if self.info is None or not self.info.num_frames:
+            return [frame for frame in self]
+        # one preallocated (N, H, W, 3) buffer from the probed frame count, grown if the count was an underestimate
+        frames, num_frames = None, 0
+        for frame in self:
+            if frames is None:
+                frames = np.empty((self.info.num_frames,) + frame.shape, dtype=frame.dtype)
+            elif num_frames == len(frames):
+                frames = np.concatenate([frames, np.empty_like(frames[:max(1, len(frames) // 4)])])
+            frames[num_frames] = frame
+            num_frames += 1
+        return frames[:num_frames] if frames is not None else []
+
+
+def fill_missing_landmarks(lm):
+    # frames without a detected face are marked with -1, reuse the previous valid landmarks
+    for idx in range(1, len(lm)):
+        if np.mean(lm[idx]) == -1:
+            lm[idx] = lm[idx - 1]
+    return lm
@@ -1,18 +1,21 @@
 import numpy as np
-import cv2, argparse, torch
+import cv2, os, argparse, functools, torch
+import torch.nn.functional as F
 import torchvision.transforms.functional as TF
+from concurrent.futures import ThreadPoolExecutor
 
 from models import load_network, load_DNet
 from tqdm import tqdm
 from PIL import Image
 from scipy.spatial import ConvexHull
-from third_part import face_detection
+from utils import model_registry
 from third_part.face3d.models import networks
+from third_part.face3d.util.preprocess import align_img
 
 import warnings
 warnings.filterwarnings("ignore")
 
-def options():
+def options(argv=None):
     parser = argparse.ArgumentParser(description='Inference code to lip-sync videos in the wild using Wav2Lip models')
 
     parser.add_argument('--DNet_path', type=str, default='checkpoints/DNet.pt')
@@ -24,10 +27,18 @@ def options():
     parser.add_argument('--exp_img', type=str, help='Expression template. neutral, smile or image path', default='neutral')
     parser.add_argument('--outfile', type=str, help='Video path to save result')
 
+    parser.add_argument('--torch_stft', default=False, action='store_true', help='Compute the mel spectrogram with torch.stft on the inference device')
+    parser.add_argument('--vcodec', type=str, default='libx264', help='ffmpeg video codec of the result')
+    parser.add_argument('--preset', type=str, default='medium', help='ffmpeg encoder preset of the result')
+    parser.add_argument('--crf', type=int, default=18, help='ffmpeg constant rate factor of the result')
+
     parser.add_argument('--fps', type=float, help='Can be specified only if input is a static image (default: 25)', default=25., required=False)
     parser.add_argument('--pads', nargs='+', type=int, default=[0, 20, 0, 0], help='Padding (top, bottom, left, right). Please adjust to include chin at least')
     parser.add_argument('--face_det_batch_size', type=int, help='Batch size for face detection', default=4)
+    parser.add_argument('--kp_batch_size', type=int, help='Batch size for the landmark extraction', default=16)
     parser.add_argument('--LNet_batch_size', type=int, help='Batch size for LNet', default=16)
+    parser.add_argument('--max_batch_latency', type=float, default=10.,
+                        help='Milliseconds a shared LNet/ENet (inference.load_lnet_server) waits to fill a batch with the work of other jobs')
     parser.add_argument('--img_size', type=int, default=384)
     parser.add_argument('--crop', nargs='+', type=int, default=[0, -1, 0, -1], 
                         help='Crop video to a smaller region (top, bottom, left, right). Applied after resize_factor and rotate arg. ' 
@@ -35,6 +46,10 @@ def options():
     parser.add_argument('--box', nargs='+', type=int, default=[-1, -1, -1, -1], 
                         help='Specify a constant bounding box for the face. Use only as a last resort if the face is not detected.'
                         'Also, might work only if the face is not moving around much. Syntax: (top, bottom, left, right).')
+    parser.add_argument('--track_interval', type=int, default=0,
+                        help='Run the full face detection only every N frames and track the face in between (0 disables tracking)')
+    parser.add_argument('--aligned_enhance', action='store_true',
+                        help='Align the faces of GFPGAN and GPEN in Step 6 with the Step 1 landmarks instead of detecting them again')
     parser.add_argument('--nosmooth', default=False, action='store_true', help='Prevent smoothing face detections over a short temporal window')
     parser.add_argument('--static', default=False, action='store_true')
 
@@ -44,8 +59,27 @@ def options():
     parser.add_argument('--without_rl1', default=False, action='store_true', help='Do not use the relative l1')
     parser.add_argument('--tmp_dir', type=str, default='temp', help='Folder to save tmp results')
     parser.add_argument('--re_preprocess', action='store_true')
+    parser.add_argument('--cache_dir', type=str, default='temp/cache', help='Folder of the preprocessing cache (landmarks, coeffs, stabilized frames)')
+    parser.add_argument('--cache_size', type=float, default=10., help='Size limit of the preprocessing cache in GB, least recently used entries are evicted')
+    parser.add_argument('--stream', action='store_true', help='Decode and process the video in bounded chunks instead of loading it into memory')
+    parser.add_argument('--chunk_size', type=int, default=64, help='Number of frames per chunk in --stream mode')
+    parser.add_argument('--stream_above', type=float, default=4.,
+                        help='Switch to --stream when the decoded video would take more than this many GB (0 disables)')
+    parser.add_argument('--max_duration', type=float, default=0.,
+                        help='Reject face/audio inputs longer than this many seconds before decoding them (0 disables)')
+    parser.add_argument('--face3d_batch_size', type=int, default=16, help='Batch size for the 3DMM coefficient extraction')
+    parser.add_argument('--DNet_batch_size', type=int, default=8, help='Batch size for the expression stabilization')
+    parser.add_argument('--face3d_workers', type=int, default=2, help='Threads aligning the frames for the 3DMM extraction, started once per pipeline')
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'fp16', 'bf16'],
+                        help='Autocast precision of LNet/ENet, DNet, GPEN, GFPGAN and the face parser (applied when the models are loaded)')
+    parser.add_argument('--channels_last', action='store_true', help='Run the same models in channels_last memory format')
+    parser.add_argument('--backend', type=str, default='torch', choices=['torch', 'onnx', 'torchscript'],
+                        help='Run LNet/ENet, DNet, GPEN and the face parser with PyTorch or their exports (see models/export.py)')
+    parser.add_argument('--export_dir', type=str, default='checkpoints/exported', help='Folder of the exported models')
+    parser.add_argument('--check_prepare', action='store_true',
+                        help='Check that LNet/ENet and DNet give the same outputs after folding their weights for inference')
     
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     return args
 
 exp_aus_dict = {        # AU01_r, AU02_r, AU04_r, AU05_r, AU06_r, AU07_r, AU09_r, AU10_r, AU12_r, AU14_r, AU15_r, AU17_r, AU20_r, AU23_r, AU25_r, AU26_r, AU45_r.
@@ -96,6 +130,26 @@ def find_crop_norm_ratio(source_coeff, target_coeffs):
     crop_norm_ratio = source_coeff[:,-3] / target_coeffs[index:index+1, -3]
     return crop_norm_ratio
 
+def transform_semantic_batch(semantic, frame_indices, crop_norm_ratios=None):
+    # same as transform_semantic for a batch of frames, the 26-frame windows are gathered at once
+    index = np.clip(np.asarray(frame_indices)[:, None] + np.arange(-13, 13), 0, semantic.shape[0]-1)
+
+    coeff_3dmm = semantic[index] # (B, 26, 262)
+    crop = coeff_3dmm[..., 259:262].copy() #crop param
+    if crop_norm_ratios is not None:
+        crop[..., -3] = crop[..., -3] * np.asarray(crop_norm_ratios).reshape(-1, 1)
+
+    coeff_3dmm = np.concatenate([coeff_3dmm[..., 80:144], coeff_3dmm[..., 224:227], coeff_3dmm[..., 254:257], crop], 2)
+    return torch.Tensor(coeff_3dmm).permute(0, 2, 1)
+
+def find_crop_norm_ratios(source_coeffs, target_coeffs):
+    # find_crop_norm_ratio for every row of source_coeffs
+    alpha = 0.3
+    exp_diff = np.mean(np.abs(target_coeffs[None, :, 80:144] - source_coeffs[:, None, 80:144]), 2)
+    angle_diff = np.mean(np.abs(target_coeffs[None, :, 224:227] - source_coeffs[:, None, 224:227]), 2)
+    index = np.argmin(alpha*exp_diff + (1-alpha)*angle_diff, 1)
+    return source_coeffs[:, -3] / target_coeffs[index, -3]
+
 def get_smoothened_boxes(boxes, T):
     for i in range(len(boxes)):
         if i + T > len(boxes):
@@ -106,11 +160,28 @@ def get_smoothened_boxes(boxes, T):
     return boxes
 
 def face_detect(images, args, jaw_correction=False, detector=None):
+    rects = face_detect_rects(images, args, detector)
+    boxes = face_boxes(rects, images[0].shape, args, jaw_correction)
+    results = [[image[y1: y2, x1:x2], (y1, y2, x1, x2)] for image, (x1, y1, x2, y2) in zip(images, boxes)]
+    return results 
+
+def face_detect_rects(images, args, detector=None):
     if detector == None:
-        device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
-        detector = face_detection.FaceAlignment(face_detection.LandmarksType._2D, 
-                                                flip_input=False, device=device)
+        detector = model_registry.get('face_detector')
+
+    if args.track_interval > 1:
+        predictions = track_rects(images, args, detector)
+    else:
+        predictions = detect_rects(images, args, detector)
+
+    for rect, image in zip(predictions, images):
+        if rect is None:
+            cv2.imwrite('temp/faulty_frame.jpg', image) # check this frame where the face was not detected.
+            raise ValueError('Face not detected! Ensure the video contains a face in all the frames.')
 
+    return predictions
+
+def detect_rects(images, args, detector):
     batch_size = args.face_det_batch_size    
     while 1:
         predictions = []
@@ -124,27 +195,61 @@ def face_detect(images, args, jaw_correction=False, detector=None):
             print('Recovering from OOM error; New batch size: {}'.format(batch_size))
             continue
         break
-
+    return predictions
+
+def rect_iou(a, b):
+    if a is None or b is None:
+        return 0.
+    w = max(0, min(a[2], b[2]) - max(a[0], b[0]))
+    h = max(0, min(a[3], b[3]) - max(a[1], b[1]))
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - w * h
+    return w * h / union if union > 0 else 0.
+
+def track_rects(images, args, detector, min_iou=0.8):
+    # detect every track_interval-th frame (and the last one). When the face barely moved between two
+    # keyframes the frames in between reuse the box of the first one, otherwise they are detected as well.
+    keyframes = list(range(0, len(images), args.track_interval))
+    if keyframes[-1] != len(images) - 1:
+        keyframes.append(len(images) - 1)
+    predictions = [None] * len(images)
+    for idx, rect in zip(keyframes, detect_rects([images[idx] for idx in keyframes], args, detector)):
+        predictions[idx] = rect
+
+    redetect = []
+    for start, end in zip(keyframes[:-1], keyframes[1:]):
+        if rect_iou(predictions[start], predictions[end]) >= min_iou:
+            predictions[start + 1:end] = [predictions[start]] * (end - start - 1)
+        else:
+            redetect.extend(range(start + 1, end))
+    if len(redetect) > 0:
+        for idx, rect in zip(redetect, detect_rects([images[idx] for idx in redetect], args, detector)):
+            predictions[idx] = rect
+    return predictions
+
+def face_boxes(rects, frame_shape, args, jaw_correction=False):
+    # pad and temporally smooth the raw detections, rects can cover the whole clip while frames are streamed
     results = []
     pady1, pady2, padx1, padx2 = args.pads if jaw_correction else (0,20,0,0)
-    for rect, image in zip(predictions, images):
-        if rect is None:
-            cv2.imwrite('temp/faulty_frame.jpg', image) # check this frame where the face was not detected.
-            raise ValueError('Face not detected! Ensure the video contains a face in all the frames.')
-
+    for rect in rects:
         y1 = max(0, rect[1] - pady1)
-        y2 = min(image.shape[0], rect[3] + pady2)
+        y2 = min(frame_shape[0], rect[3] + pady2)
         x1 = max(0, rect[0] - padx1)
-        x2 = min(image.shape[1], rect[2] + padx2)
+        x2 = min(frame_shape[1], rect[2] + padx2)
         results.append([x1, y1, x2, y2])
 
     boxes = np.array(results)
     if not args.nosmooth: boxes = get_smoothened_boxes(boxes, T=5)
-    results = [[image[y1: y2, x1:x2], (y1, y2, x1, x2)] for image, (x1, y1, x2, y2) in zip(images, boxes)]
+    return boxes
 
-    del detector
-    torch.cuda.empty_cache()
-    return results 
+def landmarks_to_5points(lm, cox, size=256):
+    # 68 landmarks of the size x size crop -> (eye centers, nose tip, mouth corners) in full frame coordinates,
+    # the 5 points retinaface gives to the enhancers. None for the frames without landmarks.
+    oy1, oy2, ox1, ox2 = cox
+    lm = np.asarray(lm, dtype=np.float32)
+    points = np.stack([lm[:, 36:42].mean(1), lm[:, 42:48].mean(1), lm[:, 30], lm[:, 48], lm[:, 54]], 1)
+    points[..., 0] = ox1 + points[..., 0] * (ox2 - ox1) / size
+    points[..., 1] = oy1 + points[..., 1] * (oy2 - oy1) / size
+    return [None if np.mean(l) == -1 else p for l, p in zip(lm, points)]
 
 def _load(checkpoint_path, device):
     if device == 'cuda':
@@ -220,9 +325,82 @@ def Laplacian_Pyramid_Blending_with_mask(A, B, m, num_levels = 6):
         ls_ = cv2.add(ls_, LS[i])
     return ls_
 
+@functools.lru_cache(maxsize=None)
+def _pyramid_kernel(device, dtype):
+    # the 5x5 gaussian of cv2.pyrDown/pyrUp
+    k = torch.tensor([1., 4., 6., 4., 1.], dtype=torch.float64) / 16.
+    return torch.outer(k, k).to(device=device, dtype=dtype)[None, None]
+
+def _pyr_blur(x, kernel):
+    # depthwise gaussian with the reflect-101 border of cv2, tiny levels fall back to replicate
+    n, c, h, w = x.shape
+    mode = 'reflect' if min(h, w) > 2 else 'replicate'
+    x = F.pad(x.reshape(n * c, 1, h, w), (2, 2, 2, 2), mode=mode)
+    return F.conv2d(x, kernel).reshape(n, c, h, w)
+
+def pyr_down(x, kernel):
+    return _pyr_blur(x, kernel)[:, :, ::2, ::2]
+
+def pyr_up(x, kernel, size):
+    n, c, h, w = x.shape
+    up = x.new_zeros(n, c, h * 2, w * 2)
+    up[:, :, ::2, ::2] = x * 4
+    return _pyr_blur(up, kernel)[:, :, :size[0], :size[1]]
+
+def laplacian_pyramid_blending_tensor(A, B, m, num_levels=6):
+    """Laplacian_Pyramid_Blending_with_mask for a batch, A and B are (N, C, H, W) tensors and m a (N, 1, H, W) mask."""
+    kernel = _pyramid_kernel(A.device, A.dtype)
+    gpA, gpB, gpM = [A], [B], [m]
+    for i in range(num_levels - 1):
+        gpA.append(pyr_down(gpA[-1], kernel))
+        gpB.append(pyr_down(gpB[-1], kernel))
+        gpM.append(pyr_down(gpM[-1], kernel))
+
+    # blend the smallest gaussian level, then add the blended laplacians level by level
+    ls = gpA[-1] * gpM[-1] + gpB[-1] * (1.0 - gpM[-1])
+    for i in range(num_levels - 2, -1, -1):
+        size = gpA[i].shape[-2:]
+        la = gpA[i] - pyr_up(gpA[i + 1], kernel, size)
+        lb = gpB[i] - pyr_up(gpB[i + 1], kernel, size)
+        ls = pyr_up(ls, kernel, size) + la * gpM[i] + lb * (1.0 - gpM[i])
+    return ls
+
+_blend_pool = None
+
+def blend_frames(As, Bs, masks, num_levels, size=(512, 512), device='cpu'):
+    """Laplacian pyramid blending of lists of same-size uint8 frames, blended at ``size`` and returned as uint8 frames.
+
+    On the GPU the whole batch is blended at once, masks can be given as a (N, 1, H, W) tensor. On the CPU
+    the frames are blended with Laplacian_Pyramid_Blending_with_mask in a thread pool.
+    """
+    height, width = As[0].shape[:2]
+    if str(device) != 'cpu':
+        to_tensor = lambda frames: torch.from_numpy(np.stack(frames)).to(device).permute(0, 3, 1, 2).float()
+        A, B = to_tensor(As), to_tensor(Bs)
+        if torch.is_tensor(masks):
+            m = masks.to(device=device, dtype=torch.float32)
+        else:
+            m = torch.from_numpy(np.stack([np.float32(mask).reshape(height, width) for mask in masks])).to(device)[:, None]
+        A, B, m = [F.interpolate(x, size, mode='bilinear', align_corners=False) for x in (A, B, m)]
+        img = laplacian_pyramid_blending_tensor(A, B, m, num_levels)
+        img = F.interpolate(img.clamp_(0, 255), (height, width), mode='bilinear', align_corners=False)
+        return list(img.permute(0, 2, 3, 1).to(torch.uint8).cpu().numpy())
+
+    global _blend_pool
+    if _blend_pool is None:
+        _blend_pool = ThreadPoolExecutor(max_workers=os.cpu_count())
+    if torch.is_tensor(masks):
+        masks = list(masks[:, 0].cpu().numpy())
+
+    def blend(a, b, mask):
+        a, b, mask = [cv2.resize(x, size) for x in (a, b, np.float32(mask).reshape(height, width))]
+        img = Laplacian_Pyramid_Blending_with_mask(a, b, mask, num_levels)
+        return np.uint8(cv2.resize(np.clip(img, 0, 255), (width, height)))
+    return list(_blend_pool.map(blend, As, Bs, masks))
+
 def load_model(args, device):
-    D_Net = load_DNet(args).to(device)
-    model = load_network(args).to(device)
+    D_Net = load_DNet(args, device).to(device)
+    model = load_network(args, device).to(device)
     return D_Net, model
 
 def normalize_kp(kp_source, kp_driving, kp_driving_initial, adapt_movement_scale=False,
@@ -250,4 +428,30 @@ def load_face3d_net(ckpt_path, device):
     checkpoint = torch.load(ckpt_path, map_location=device)    
     net_recon.load_state_dict(checkpoint['net_recon'])
     net_recon.eval()
-    return net_recon
\ No newline at end of file
+    return net_recon
+
+class AlignedFramesDataset(torch.utils.data.Dataset):
+    """Aligns the cropped frames with their landmarks for the face3d net (see face_recon_videos.VideoPathDataset)."""
+    def __init__(self, frames_pil, lm, lm3d_std):
+        self.frames_pil = frames_pil
+        self.lm = lm
+        self.lm3d_std = lm3d_std
+
+    def __len__(self):
+        return len(self.frames_pil)
+
+    def __getitem__(self, index):
+        frame = self.frames_pil[index]
+        W, H = frame.size
+        lm = self.lm[index].reshape([-1, 2]).copy()
+        if np.mean(lm) == -1:
+            lm = (self.lm3d_std[:, :2]+1) / 2.
+            lm = np.concatenate([lm[:, :1] * W, lm[:, 1:2] * H], 1)
+        else:
+            lm[:, -1] = H - 1 - lm[:, -1]
+
+        trans_params, img, lm, _ = align_img(frame, lm, self.lm3d_std)
+        img = torch.tensor(np.array(img)/255., dtype=torch.float32).permute(2, 0, 1)
+        trans_params = np.array([float(item) for item in np.hsplit(trans_params, 5)]).astype(np.float32)
+        return img, torch.tensor(trans_params)
+
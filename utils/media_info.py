@@ -0,0 +1,98 @@
+import os
+import wave
+import functools
+from collections import namedtuple
+
+import ffmpeg
+from PIL import Image
+
+from utils.frame_stream import IMAGE_EXTENSIONS
+
+
+class MediaInfo(namedtuple('MediaInfo', ['path', 'duration', 'fps', 'width', 'height', 'num_frames', 'sample_rate'])):
+    """Duration (s), video fps / size / frame count and audio sample rate of a file, None where absent.
+
+    ``num_frames`` comes from the container and can be an estimate, it is only used to size buffers.
+    """
+
+    @property
+    def has_video(self):
+        return self.width is not None
+
+    @property
+    def decoded_bytes(self):
+        # size of all the BGR frames once decoded
+        if not self.has_video or not self.num_frames:
+            return 0
+        return self.num_frames * self.width * self.height * 3
+
+
+def probe(path):
+    """Probes a local image, wav, video or audio file without decoding it. Results are cached per file
+    (path, modification time and size), so the API, the pipeline and the frame reader share one probe."""
+    if not os.path.isfile(path):
+        return _probe(path)
+    stat = os.stat(path)
+    return _probe_cached(os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+
+@functools.lru_cache(maxsize=256)
+def _probe_cached(path, mtime, size):
+    return _probe(path)
+
+
+def _probe(path):
+    extension = path.split('.')[-1].lower()
+    if extension in IMAGE_EXTENSIONS:
+        # PIL only reads the header here
+        with Image.open(path) as img:
+            width, height = img.size
+        return MediaInfo(path, None, None, width, height, 1, None)
+    if extension == 'wav':
+        try:
+            with wave.open(path) as f:
+                return MediaInfo(path, f.getnframes() / f.getframerate(), None, None, None, None, f.getframerate())
+        except (wave.Error, EOFError):
+            pass  # e.g. float wavs, let ffprobe read them
+
+    # a single ffprobe for the container and all its streams
+    info = ffmpeg.probe(path)
+    video = next((s for s in info['streams'] if s['codec_type'] == 'video'), None)
+    audio = next((s for s in info['streams'] if s['codec_type'] == 'audio'), None)
+    duration = _float(info.get('format', {}).get('duration'))
+    fps = width = height = num_frames = sample_rate = None
+    if video is not None:
+        fps = _rate(video.get('avg_frame_rate')) or _rate(video.get('r_frame_rate'))
+        width, height = video.get('width'), video.get('height')
+        duration = duration or _float(video.get('duration'))
+        num_frames = int(video['nb_frames']) if video.get('nb_frames') else None
+        if num_frames is None and duration and fps:
+            num_frames = int(round(duration * fps))
+    if audio is not None:
+        sample_rate = int(audio['sample_rate']) if audio.get('sample_rate') else None
+        duration = duration or _float(audio.get('duration'))
+    return MediaInfo(path, duration, fps, width, height, num_frames, sample_rate)
+
+
+def _float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _rate(value):
+    # ffprobe frame rates are fractions, e.g. 30000/1001, 0/0 when unknown
+    if not value:
+        return None
+    num, _, den = value.partition('/')
+    num, den = _float(num), _float(den or 1)
+    return num / den if num and den else None
+
+
+def check_duration(info, max_duration):
+    """Raises a ValueError if the file is longer than ``max_duration`` seconds (0 or None disables)."""
+    if not max_duration or info.duration is None:
+        return
+    if info.duration > max_duration:
+        raise ValueError('{} is {:.1f}s long, the limit is {}s'.format(os.path.basename(info.path), info.duration, max_duration))
@@ -0,0 +1,81 @@
+import time
+import queue
+import threading
+from concurrent.futures import Future
+
+import torch
+
+
+class MicroBatcher:
+    """Runs a batched model for several threads, fusing their work items into full batches.
+
+    ``submit(*inputs)`` queues a work item (tensors sharing their first, batch, dimension) and returns a
+    Future. A server thread takes the first queued item, adds the following ones until the batch holds
+    ``max_batch_size`` rows or ``max_latency`` seconds passed, runs the model once on the concatenated
+    inputs and scatters the outputs back to the futures. Calling the batcher like the model blocks until
+    the item is done, so it can stand in for the model, e.g. the LNet/ENet of ``inference.Pipeline``.
+    """
+
+    def __init__(self, model, max_batch_size=16, max_latency=0.01):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.pending = queue.Queue()
+        self.batches, self.rows = 0, 0
+        self._carry = None
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+        self.thread.start()
+
+    def submit(self, *inputs):
+        future = Future()
+        self.pending.put((inputs, future))
+        return future
+
+    def __call__(self, *inputs):
+        return self.submit(*inputs).result()
+
+    def _collect(self):
+        # an item that did not fit in the previous batch starts the next one
+        item, self._carry = self._carry or self.pending.get(), None
+        items, size = [item], len(item[0][0])
+        deadline = time.monotonic() + self.max_latency
+        while size < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self.pending.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if size + len(item[0][0]) > self.max_batch_size:
+                self._carry = item
+                break
+            items.append(item)
+            size += len(item[0][0])
+        return items
+
+    def _serve(self):
+        while True:
+            items = self._collect()
+            sizes = [len(inputs[0]) for inputs, _ in items]
+            try:
+                inputs = [torch.cat(x, 0) if len(items) > 1 else x[0] for x in zip(*[inputs for inputs, _ in items])]
+                with torch.no_grad():
+                    outputs = self.model(*inputs)
+            except Exception as e:
+                for _, future in items:
+                    future.set_exception(e)
+                continue
+            self.batches, self.rows = self.batches + 1, self.rows + sum(sizes)
+
+            if torch.is_tensor(outputs):
+                for future, output in zip([future for _, future in items], outputs.split(sizes)):
+                    future.set_result(output)
+            else:
+                parts = [output.split(sizes) for output in outputs]
+                for i, (_, future) in enumerate(items):
+                    future.set_result(type(outputs)(part[i] for part in parts))
+
+    @property
+    def mean_batch_size(self):
+        return self.rows / self.batches if self.batches else 0.
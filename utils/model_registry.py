@@ -0,0 +1,91 @@
+"""Process-wide singletons of the face detection and landmark models.
+
+Every pipeline stage asks the registry for its detector instead of building its own, models are
+constructed on first use and stay loaded until ``release`` is called. Only stateless models are
+registered here, they can be shared by several pipelines running in threads.
+"""
+import threading
+import torch
+
+
+_factories = {}
+_instances = {}
+_lock = threading.RLock()
+
+device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+
+def register(name, factory):
+    with _lock:
+        _factories[name] = factory
+
+
+def get(name):
+    with _lock:
+        if name not in _instances:
+            _instances[name] = _factories[name]()
+        return _instances[name]
+
+
+def release(*names):
+    # release the given models (all of them by default), they are constructed again on the next get
+    with _lock:
+        for name in names or list(_instances):
+            _instances.pop(name, None)
+    torch.cuda.empty_cache()
+
+
+def loaded():
+    with _lock:
+        return list(_instances)
+
+
+def _kp_extractor():
+    # face_alignment S3FD + FAN
+    from third_part.face3d.extract_kp_videos import KeypointExtractor
+    return KeypointExtractor()
+
+
+def _face_detector():
+    # both S3FD wrappers use the s3fd-619a316812 weights, reuse the network of face_alignment
+    from third_part import face_detection
+    s3fd_net = get('kp_extractor').detector.face_detector.face_detector
+    return face_detection.FaceAlignment(face_detection.LandmarksType._2D, flip_input=False, device=device,
+                                        face_detector_kwargs={'net': s3fd_net})
+
+
+def _retinaface():
+    from face_detect.retinaface_detection import RetinaFaceDetection
+    return RetinaFaceDetection('checkpoints', device)
+
+
+class _LockedDetector:
+    # facexlib's RetinaFace keeps the scales and priors of the last image on the instance, the callers take turns
+    def __init__(self, detector):
+        self.detector = detector
+        self.lock = threading.Lock()
+
+    def detect_faces(self, *args, **kwargs):
+        with self.lock:
+            return self.detector.detect_faces(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.detector, name)
+
+
+def _gfpgan_face_det():
+    # the retinaface_resnet50 of facexlib used by the FaceRestoreHelper of GFPGANer
+    from facexlib.detection import init_detection_model
+    return _LockedDetector(init_detection_model('retinaface_resnet50', half=False, device=device))
+
+
+def _croper():
+    from utils.ffhq_preprocess import Croper
+    return Croper('checkpoints/shape_predictor_68_face_landmarks.dat')
+
+
+register('kp_extractor', _kp_extractor)
+register('face_detector', _face_detector)
+register('retinaface', _retinaface)
+register('croper', _croper)
+register('gfpgan_face_det', _gfpgan_face_det)
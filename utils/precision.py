@@ -0,0 +1,60 @@
+import functools
+import torch
+
+
+DTYPES = {'fp32': torch.float32, 'fp16': torch.float16, 'bf16': torch.bfloat16}
+
+
+def autocast_dtype(device, precision):
+    # autocast dtype of the precision option on the device, None for fp32. CPU autocast only supports bf16.
+    if precision == 'fp32':
+        return None
+    if torch.device(device).type == 'cpu' and precision == 'fp16':
+        print('[Info] fp16 autocast is not supported on cpu, using bf16.')
+        precision = 'bf16'
+    return DTYPES[precision]
+
+
+def _to_float(out):
+    # the outputs of an autocast forward back to fp32, the callers convert them to numpy
+    if torch.is_tensor(out):
+        return out.float() if out.is_floating_point() else out
+    if isinstance(out, (list, tuple)):
+        return type(out)(_to_float(o) for o in out)
+    if isinstance(out, dict):
+        return {k: _to_float(v) for k, v in out.items()}
+    return out
+
+
+def _to_channels_last(x):
+    return x.contiguous(memory_format=torch.channels_last) if torch.is_tensor(x) and x.dim() == 4 else x
+
+
+def set_precision(model, device, precision='fp32', channels_last=False):
+    """Runs the forward of ``model`` under fp16/bf16 autocast and/or in channels_last memory format.
+
+    The weights stay in fp32, autocast casts them per op, and the outputs are returned in fp32. The parts
+    that have to stay in fp32 (models.ffc.FourierUnit, models.base_blocks.LayerNorm2d) disable autocast.
+    """
+    dtype = autocast_dtype(device, precision)
+    if dtype is None and not channels_last:
+        return model
+    if channels_last:
+        model.to(memory_format=torch.channels_last)
+
+    forward = model.forward
+    device_type = torch.device(device).type
+
+    @functools.wraps(forward)
+    def precision_forward(*args, **kwargs):
+        if channels_last:
+            args = [_to_channels_last(a) for a in args]
+            kwargs = {k: _to_channels_last(v) for k, v in kwargs.items()}
+        if dtype is None:
+            return forward(*args, **kwargs)
+        with torch.autocast(device_type, dtype=dtype):
+            out = forward(*args, **kwargs)
+        return _to_float(out)
+
+    model.forward = precision_forward
+    return model
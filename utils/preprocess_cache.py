@@ -0,0 +1,122 @@
+import os
+import json
+import time
+import uuid
+import hashlib
+import threading
+import numpy as np
+from collections import OrderedDict
+
+
+# least recently used digests, the service hashes every upload
+_file_digests = OrderedDict()
+_file_digests_lock = threading.Lock()
+MAX_FILE_DIGESTS = 1024
+# age in seconds after which a temp file is considered left over by a crashed writer
+STALE_TMP_AGE = 24 * 3600
+
+def file_digest(path, block_size=1 << 20):
+    # sha256 of the file content, memoized by (path, size, mtime) so a run only reads the video once
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime)
+    with _file_digests_lock:
+        if memo_key in _file_digests:
+            _file_digests.move_to_end(memo_key)
+            return _file_digests[memo_key]
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    with _file_digests_lock:
+        _file_digests[memo_key] = sha.hexdigest()
+        while len(_file_digests) > MAX_FILE_DIGESTS:
+            _file_digests.popitem(last=False)
+    return sha.hexdigest()
+
+
+class PreprocessCache:
+    """Content-addressed cache for the preprocessing results (landmarks, 3DMM coeffs, stabilized frames).
+
+    Entries are keyed by the content hash of the input files plus the options they depend on, so the
+    same video uploaded under another name hits the cache and two different videos with the same name
+    never share entries. The total size is bounded by ``max_size`` bytes, the least recently used
+    entries are evicted first.
+    """
+
+    def __init__(self, cache_dir='temp/cache', max_size=10 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, *paths, **opts):
+        sha = hashlib.sha256()
+        for path in paths:
+            sha.update(file_digest(path).encode())
+        sha.update(json.dumps(opts, sort_keys=True, default=str).encode())
+        return sha.hexdigest()
+
+    def path(self, key, name):
+        return os.path.join(self.cache_dir, '{}_{}.npy'.format(key, name))
+
+    def load(self, key, name, mmap_mode=None):
+        path = self.path(key, name)
+        if not os.path.isfile(path):
+            return None
+        os.utime(path)  # mark as recently used
+        return np.load(path, mmap_mode=mmap_mode)
+
+    def tmp_path(self, key, name):
+        # unique per writer, the pipelines of a service are threads of one process and can fill the same entry
+        return '{}.{}.tmp'.format(self.path(key, name), uuid.uuid4().hex)
+
+    def save(self, key, name, array):
+        path = self.path(key, name)
+        tmp_path = self.tmp_path(key, name)
+        with open(tmp_path, 'wb') as f:
+            np.save(f, array)
+        os.replace(tmp_path, path)
+        self.evict(keep=path)
+
+    def open_memmap(self, key, name, shape, dtype=np.uint8):
+        # a .npy file that is filled in place without holding the whole array in memory, see save_memmap
+        tmp_path = self.tmp_path(key, name)
+        return np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=shape)
+
+    def save_memmap(self, key, name, array):
+        path = self.path(key, name)
+        array.flush()
+        os.replace(array.filename, path)
+        self.evict(keep=path)
+
+    def discard_memmap(self, array):
+        # drop an open_memmap file that was not filled, e.g. the stabilization failed
+        try:
+            os.remove(array.filename)
+        except FileNotFoundError:
+            pass
+
+    def evict(self, keep=None):
+        entries = []
+        for file_name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, file_name)
+            if file_name.endswith('.tmp') and os.path.isfile(path):
+                # temp files of writers that died, the ones still being written are younger
+                try:
+                    if time.time() - os.stat(path).st_mtime > STALE_TMP_AGE:
+                        os.remove(path)
+                except FileNotFoundError:
+                    pass
+            elif file_name.endswith('.npy') and os.path.isfile(path):
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size